@@ -0,0 +1,160 @@
+"""Module for annotating sample variants with the converged mutation catalogue"""
+
+import os
+import re
+import csv
+import json
+from jasentool.cache import Cache
+from jasentool.catalogue import Catalogue
+from jasentool.convert import Convert
+
+class Annotate:
+    """Class that streams vcf or JASEN result json variants through a catalogue index"""
+    catalogue_columns = ["Drug", "Confers", "Interaction", "Literature", "WHO Confidence"]
+    output_columns = ["sample", "chrom", "pos", "ref", "alt", "gene", "hgvs_c", "hgvs_p",
+                      "match", "Mutation"] + catalogue_columns
+    re_codon = re.compile(r'^p\.[A-Z][a-z]{2}([0-9]+)')
+    re_nucleotide = re.compile(r'^[cn]\.(-?[0-9]+)')
+    re_rna = re.compile(r'^n\.([0-9]+)([ACGT]+)>([ACGT]+)$')
+
+    def __init__(self, catalogue_filepath, cache_dir=None):
+        # Compiled catalogue index is cached per catalogue file
+        self.catalogue = Cache(cache_dir).cached(
+            "catalogue", lambda: Catalogue.read_csv(catalogue_filepath), catalogue_filepath)
+
+    @staticmethod
+    def find_input_files(input_dir):
+        """Find vcf and JASEN result json files in directory"""
+        return sorted(os.path.join(input_dir, filename) for filename in os.listdir(input_dir)
+                      if filename.endswith((".vcf", ".vcf.gz", "result.json")))
+
+    @staticmethod
+    def parse_ann(info, alt):
+        """snpEff ANN annotations of alt as (gene, gene_id, effects, hgvs_c, hgvs_p)"""
+        for field in info.split(";"):
+            if not field.startswith("ANN="):
+                continue
+            for ann in field[4:].split(","):
+                ann = ann.split("|")
+                if len(ann) > 10 and ann[0] == alt:
+                    yield ann[3], ann[4], ann[1].split("&"), ann[9], ann[10]
+
+    @staticmethod
+    def read_vcf(vcf_filepath):
+        """Stream variants of a (gzipped) vcf annotated by snpEff"""
+        with Convert.open_text(vcf_filepath) as fin:
+            samples = []
+            for line in fin:
+                if line.startswith("##"):
+                    continue
+                fields = line.rstrip("\n").split("\t")
+                if line.startswith("#"):
+                    samples = fields[9:]
+                    continue
+                chrom, pos, _, ref, alts, _, _, info = fields[:8]
+                for alt in alts.split(","):
+                    yield {
+                        "sample": samples[0] if len(samples) == 1 else vcf_filepath,
+                        "chrom": chrom, "pos": int(pos), "ref": ref, "alt": alt,
+                        "annotations": list(Annotate.parse_ann(info, alt)),
+                    }
+
+    @staticmethod
+    def find_variants(result):
+        """Yield every variant dictionary nested under a 'variants' key"""
+        if isinstance(result, dict):
+            for key, value in result.items():
+                if key == "variants" and isinstance(value, list):
+                    yield from (variant for variant in value if isinstance(variant, dict))
+                else:
+                    yield from Annotate.find_variants(value)
+        elif isinstance(result, list):
+            for value in result:
+                yield from Annotate.find_variants(value)
+
+    @staticmethod
+    def read_jasen_json(json_filepath):
+        """Stream predicted variants of a JASEN result json"""
+        with open(json_filepath, 'r', encoding="utf-8") as fin:
+            result = json.load(fin)
+        sample_id = result.get("sample_id", json_filepath) if isinstance(result, dict) \
+            else json_filepath
+        for variant in Annotate.find_variants(result):
+            gene = variant.get("gene_symbol") or variant.get("reference_sequence") or \
+                variant.get("gene") or ""
+            effects = [variant.get("variant_subtype") or "", variant.get("variant_type") or ""]
+            pos = variant.get("start") or variant.get("pos")
+            yield {
+                "sample": sample_id,
+                "chrom": variant.get("accession") or variant.get("chrom") or "",
+                "pos": int(pos) if pos is not None else None,
+                "ref": variant.get("ref_nt") or variant.get("ref") or "",
+                "alt": variant.get("alt_nt") or variant.get("alt") or "",
+                "annotations": [(gene, variant.get("locus_tag") or "", effects,
+                                 variant.get("hgvs_nt_change") or "",
+                                 variant.get("hgvs_aa_change") or "")],
+            }
+
+    def read_variants(self, input_filepath):
+        """Stream variants of a vcf or JASEN result json file"""
+        if input_filepath.endswith(".json"):
+            return self.read_jasen_json(input_filepath)
+        return self.read_vcf(input_filepath)
+
+    def match_annotation(self, gene, effects, hgvs_c, hgvs_p):
+        """(row, match type) of catalogue rules matching one gene annotation"""
+        matches = []
+        hgvs = [hgvs_p, hgvs_c]
+        rna = self.re_rna.match(hgvs_c)
+        if rna:
+            # tbdb writes rRNA changes as r.1401a>g
+            hgvs.append(f"r.{rna[1]}{rna[2].lower()}>{rna[3].lower()}")
+        for mutation in filter(None, hgvs):
+            matches.extend((row, "hgvs") for row in self.catalogue.lookup(gene, mutation))
+        effects = " ".join(effects).lower()
+        for effect, mutation in (("frameshift", "frameshift"), ("stop_gained", "premature_stop"),
+                                 ("feature_ablation", "large_deletion")):
+            if effect in effects:
+                matches.extend((row, mutation) for row in self.catalogue.lookup(gene, mutation))
+        codon = self.re_codon.match(hgvs_p)
+        if codon and "missense" in effects:
+            matches.extend((row, "codon_range") for row in self.catalogue.lookup_position(
+                gene, "missense_codon", int(codon[1])))
+        nucleotide = self.re_nucleotide.match(hgvs_c)
+        if nucleotide and any(kind in effects for kind in ("frameshift", "del", "ins")):
+            matches.extend((row, "indel_range") for row in self.catalogue.lookup_position(
+                gene, "indel_nucleotide", int(nucleotide[1])))
+        return matches
+
+    def annotate_variant(self, variant):
+        """Output rows of every catalogue rule matching variant"""
+        matches = {}
+        if variant["pos"] is not None:
+            for row in self.catalogue.lookup_genomic(variant["chrom"], variant["pos"],
+                                                     variant["ref"], variant["alt"]):
+                matches.setdefault(row, ("genomic", "", "", ""))
+        for gene, gene_id, effects, hgvs_c, hgvs_p in variant["annotations"]:
+            for gene_key in dict.fromkeys(filter(None, (gene, gene_id))):
+                for row, match in self.match_annotation(gene_key, effects, hgvs_c, hgvs_p):
+                    matches.setdefault(row, (match, gene, hgvs_c, hgvs_p))
+        for row, (match, gene, hgvs_c, hgvs_p) in matches.items():
+            rule = self.catalogue.df.loc[row]
+            output = {key: variant[key] for key in ("sample", "chrom", "pos", "ref", "alt")}
+            output.update({"gene": gene or rule.Gene, "hgvs_c": hgvs_c, "hgvs_p": hgvs_p,
+                           "match": match, "Mutation": rule.Mutation})
+            output.update({column: rule.get(column, "") for column in self.catalogue_columns})
+            yield output
+
+    def run(self, input_filepaths, output_filepath):
+        """Annotate variants of all input files and write matches to a tsv file"""
+        count = 0
+        with open(output_filepath, 'w', encoding="utf-8", newline='') as fout:
+            writer = csv.DictWriter(fout, fieldnames=self.output_columns, delimiter="\t")
+            writer.writeheader()
+            for input_filepath in input_filepaths:
+                for variant in self.read_variants(input_filepath):
+                    for output in self.annotate_variant(variant):
+                        writer.writerow(output)
+                        count += 1
+        print(f"Wrote {count} catalogue matches to {output_filepath}")
+        return count
@@ -0,0 +1,126 @@
+"""Module for collecting alignment QC statistics in a single pass over a BAM file"""
+
+from array import array
+import numpy as np
+from jasentool.convert import Convert
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+class BamStats:
+    """Class that counts reads, samples insert sizes and accumulates depth in one pass"""
+    FLAG_PAIRED = 0x1
+    FLAG_PROPER_PAIR = 0x2
+    FLAG_UNMAPPED = 0x4
+    FLAG_MATE_UNMAPPED = 0x8
+    FLAG_SECONDARY = 0x100
+    FLAG_QC_FAIL = 0x200
+    FLAG_DUPLICATE = 0x400
+    FLAG_SUPPLEMENTARY = 0x800
+    # Reads excluded from depth, together with reads below min_mapq (sambamba depth's default
+    # filter is "mapping_quality > 0 and not duplicate and not failed_quality_control and
+    # not unmapped and not secondary_alignment")
+    DEPTH_FILTER = FLAG_UNMAPPED | FLAG_SECONDARY | FLAG_QC_FAIL | FLAG_DUPLICATE
+    INSERT_FILTER = (FLAG_UNMAPPED | FLAG_MATE_UNMAPPED | FLAG_SECONDARY | FLAG_QC_FAIL |
+                     FLAG_DUPLICATE | FLAG_SUPPLEMENTARY)
+
+    def __init__(self, bam_file, bed_file=None, threads=1, insert_size_sample=1000000,
+                 flush_size=1000000, min_mapq=1):
+        self.bam_file = bam_file
+        self.min_mapq = min_mapq
+        self.bed_file = bed_file
+        self.threads = threads
+        self.insert_size_sample = insert_size_sample
+        self.flush_size = flush_size
+        self.depth = {}
+        self.lengths = {}
+
+    @staticmethod
+    def available():
+        """Check if pysam is installed"""
+        return pysam is not None
+
+    def _flush_blocks(self, contig, length, starts, ends):
+        """Add buffered aligned blocks to the contig's difference array"""
+        diff = self.depth.setdefault(contig, np.zeros(length + 1, dtype=np.int64))
+        diff += np.bincount(np.frombuffer(starts, dtype=np.int64), minlength=length + 1)
+        diff -= np.bincount(np.frombuffer(ends, dtype=np.int64), minlength=length + 1)
+        del starts[:]
+        del ends[:]
+
+    def collect(self):
+        """Read the BAM once and return counts, insert size stats and per-contig depth"""
+        if pysam is None:
+            raise ImportError("pysam is required for in-process BAM statistics")
+        counts = {"paired": 0, "tot_reads": 0, "mapped_reads": 0, "dup_reads": 0}
+        insert_sizes = array('q')
+        with pysam.AlignmentFile(self.bam_file, "rb", threads=self.threads) as bam:
+            lengths = dict(zip(bam.references, bam.lengths))
+            block_starts = {contig: array('q') for contig in lengths}
+            block_ends = {contig: array('q') for contig in lengths}
+            first_read = True
+            for read in bam.fetch(until_eof=True):
+                flag = read.flag
+                if first_read:
+                    counts["paired"] = 1 if flag & self.FLAG_PAIRED else 0
+                    first_read = False
+                # Counts are QC-passed reads, as in the first column of flagstat
+                if flag & self.FLAG_QC_FAIL:
+                    continue
+                counts["tot_reads"] += 1
+                if flag & self.FLAG_DUPLICATE:
+                    counts["dup_reads"] += 1
+                if flag & self.FLAG_UNMAPPED:
+                    continue
+                counts["mapped_reads"] += 1
+
+                if (flag & self.FLAG_PAIRED and not flag & self.INSERT_FILTER and
+                        read.template_length > 0 and
+                        len(insert_sizes) < self.insert_size_sample):
+                    insert_sizes.append(read.template_length)
+
+                if flag & self.DEPTH_FILTER or read.mapping_quality < self.min_mapq:
+                    continue
+                contig = read.reference_name
+                starts, ends = block_starts[contig], block_ends[contig]
+                for block_start, block_end in read.get_blocks():
+                    starts.append(block_start)
+                    ends.append(block_end)
+                if len(starts) >= self.flush_size:
+                    self._flush_blocks(contig, lengths[contig], starts, ends)
+
+            for contig, length in lengths.items():
+                if block_starts[contig] or contig in self.depth:
+                    self._flush_blocks(contig, length, block_starts[contig], block_ends[contig])
+
+        # Turn difference arrays into per-base depth
+        self.depth = {contig: np.cumsum(diff[:-1]) for contig, diff in self.depth.items()}
+        self.lengths = lengths
+        if insert_sizes:
+            sizes = np.frombuffer(insert_sizes, dtype=np.int64)
+            counts["ins_size"] = float(sizes.mean())
+            counts["ins_size_dev"] = float(sizes.std())
+        return counts
+
+    def contig_depth(self, contig):
+        """Per-base depth of a contig, zeros if no reads aligned to it"""
+        if contig not in self.depth:
+            return np.zeros(self.lengths[contig], dtype=np.int64)
+        return self.depth[contig]
+
+    def depth_histogram(self):
+        """Histogram of per-base depth over the bed regions, or the whole genome without a bed"""
+        hist = np.zeros(1, dtype=np.int64)
+        if self.bed_file:
+            segments = ((self.contig_depth(chrom)[start:end])
+                        for chrom, start, end, _, _ in Convert.read_bed(self.bed_file))
+        else:
+            segments = (self.contig_depth(contig) for contig in self.lengths)
+        for segment in segments:
+            counts = np.bincount(segment)
+            if len(counts) > len(hist):
+                hist = np.pad(hist, (0, len(counts) - len(hist)))
+            hist[:len(counts)] += counts
+        return hist
@@ -0,0 +1,81 @@
+"""Module for incremental builds that skip stages whose inputs have not changed"""
+
+import os
+import json
+import threading
+from jasentool import __version__
+from jasentool.cache import Cache
+from jasentool.utils import Utils
+
+class Build:
+    """Class that records input and output hashes and the jasentool version per stage in a
+    manifest and reruns a stage only when they differ from the previous run"""
+    def __init__(self, manifest_filepath, force=False, dry_run=False):
+        self.manifest_filepath = manifest_filepath
+        self.force = force
+        self.dry_run = dry_run
+        self.manifest = self.load_manifest()
+        self.plan = []
+        self.pending = set()
+        self._lock = threading.Lock()
+
+    def load_manifest(self):
+        """Load stage records of the previous run"""
+        if not os.path.isfile(self.manifest_filepath):
+            return {}
+        with open(self.manifest_filepath, 'r', encoding="utf-8") as fin:
+            return json.load(fin)
+
+    def save_manifest(self):
+        """Atomically write stage records"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_filepath)), exist_ok=True)
+        with Cache.atomic_write(self.manifest_filepath) as fout:
+            json.dump(self.manifest, fout, indent=2, sort_keys=True)
+
+    @staticmethod
+    def hashes(filepaths):
+        """Checksums of files, None for missing ones"""
+        return {filepath: Utils.file_checksum(filepath) if os.path.isfile(filepath) else None
+                for filepath in filepaths}
+
+    def reason(self, name, inputs, outputs):
+        """Why stage name has to run, None if its recorded outputs are still current"""
+        if self.force:
+            return "forced"
+        pending = [filepath for filepath in inputs if filepath in self.pending]
+        if pending:
+            return f"{', '.join(os.path.basename(path) for path in pending)} will be rebuilt"
+        record = self.manifest.get(name)
+        if record is None:
+            return "never built"
+        if record.get("version") != __version__:
+            return f"built by jasentool {record.get('version', 'unknown')}"
+        if record["inputs"] != self.hashes(inputs):
+            return "inputs changed"
+        if record["outputs"] != self.hashes(outputs):
+            return "outputs missing or modified"
+        return None
+
+    def stage(self, name, func, inputs, outputs):
+        """Run func unless stage name is current, returns True if it (would have) run"""
+        with self._lock:
+            reason = self.reason(name, inputs, outputs)
+            self.plan.append((name, "run" if reason else "skip", reason or "up to date"))
+            if reason and self.dry_run:
+                self.pending.update(outputs)
+        if self.dry_run:
+            return reason is not None
+        if reason is None:
+            print(f"Skipping {name}: up to date")
+            return False
+        func()
+        with self._lock:
+            self.manifest[name] = {"inputs": self.hashes(inputs), "outputs": self.hashes(outputs),
+                                   "version": __version__}
+            self.save_manifest()
+        return True
+
+    def print_plan(self):
+        """Print which stages run and why"""
+        for name, action, reason in self.plan:
+            print(f"{action}\t{name}\t{reason}")
@@ -0,0 +1,60 @@
+"""Module for jasentool's local content-keyed cache"""
+
+import os
+import pickle
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from jasentool import __version__
+from jasentool.utils import Utils
+
+class Cache:
+    """Class for locating, keying and atomically writing cached files"""
+    def __init__(self, cache_dir=None):
+        if not cache_dir:
+            cache_dir = os.environ.get("JASENTOOL_CACHE_DIR") or os.path.join(
+                os.environ.get("XDG_CACHE_HOME", "~/.cache"), "jasentool")
+        self.cache_dir = os.path.expanduser(cache_dir)
+
+    def get_path(self, *parts):
+        """Get path within the cache, creating its parent directory"""
+        filepath = os.path.join(self.cache_dir, *parts)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        return filepath
+
+    @staticmethod
+    def content_key(*filepaths, extra=""):
+        """Key derived from file contents, the jasentool version and optional extra text"""
+        digest = hashlib.sha256(f"{__version__}\t{extra}".encode("utf-8"))
+        for filepath in filepaths:
+            digest.update(Utils.file_checksum(filepath).encode("utf-8"))
+        return digest.hexdigest()
+
+    def cached(self, name, loader, *filepaths, extra=""):
+        """Return loader(), pickled in the cache under a key of the source files, jasentool
+        version and extra text so it is only recomputed when its sources change"""
+        key = self.content_key(*filepaths, extra=extra)
+        filepath = self.get_path(name, f"{key}.pickle")
+        if os.path.isfile(filepath):
+            with open(filepath, 'rb') as fin:
+                return pickle.load(fin)
+        result = loader()
+        with self.atomic_write(filepath, 'wb') as fout:
+            pickle.dump(result, fout, protocol=pickle.HIGHEST_PROTOCOL)
+        return result
+
+    @staticmethod
+    @contextmanager
+    def atomic_write(filepath, mode='w'):
+        """Write to a temporary file in the same directory and rename it into place"""
+        dirname = os.path.dirname(os.path.abspath(filepath))
+        fd, tmp_filepath = tempfile.mkstemp(dir=dirname, prefix=".tmp_")
+        try:
+            encoding = None if 'b' in mode else "utf-8"
+            with os.fdopen(fd, mode, encoding=encoding) as fout:
+                yield fout
+            os.replace(tmp_filepath, filepath)
+        except BaseException:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            raise
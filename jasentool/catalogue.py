@@ -0,0 +1,143 @@
+"""Module for indexed lookups in converged mutation catalogues"""
+
+import os
+import re
+import sqlite3
+import numpy as np
+import pandas as pd
+from jasentool import __version__
+from jasentool.utils import Utils
+
+class Catalogue:
+    """Class that indexes catalogue rules by gene and mutation, keeping codon and nucleotide
+    range rules as intervals that are only expanded for flat exports"""
+    re_range = re.compile(r'^any_(missense_codon|indel_nucleotide)_([0-9]+)(?:_([0-9]+))?$')
+    re_genomic = re.compile(r'^([0-9]+)([ACGTN]+)>([ACGTN]+)$')
+
+    def __init__(self, catalogue_df):
+        self.df = catalogue_df.reset_index(drop=True)
+        self.exact = {}
+        self.genomic = {}
+        self.intervals = {}
+        self.index_rules()
+
+    @classmethod
+    def read_csv(cls, csv_filepath):
+        """Index catalogue csv file"""
+        return cls(pd.read_csv(csv_filepath, dtype=str, keep_default_na=False))
+
+    @classmethod
+    def parse_range(cls, mutation):
+        """(kind, start, end) of a range rule, None for other mutations"""
+        match = cls.re_range.match(mutation)
+        if match is None:
+            return None
+        start = int(match[2])
+        return match[1], start, int(match[3]) if match[3] else start
+
+    def index_rules(self):
+        """Split rows into exact (gene, mutation) rules and per gene interval rules"""
+        ranges = {}
+        for row_idx, gene, mutation in zip(self.df.index, self.df.Gene, self.df.Mutation):
+            rule_range = self.parse_range(mutation)
+            if rule_range is None:
+                self.exact.setdefault((gene, mutation), []).append(row_idx)
+            else:
+                kind, start, end = rule_range
+                ranges.setdefault((gene, kind), []).append((start, end, row_idx))
+        # tbdb indels are translated to vcf style genomic pos, ref and alt, flagged by their
+        # Chromosome (other translations like r.514a>c -> 514A>C are relative to the gene)
+        if 'Translation' in self.df and 'Chromosome' in self.df:
+            for row_idx, chrom, translation in zip(self.df.index, self.df.Chromosome,
+                                                   self.df.Translation):
+                match = self.re_genomic.match(translation) \
+                    if isinstance(chrom, str) and chrom and isinstance(translation, str) else None
+                if match:
+                    key = (chrom, int(match[1]), match[2], match[3])
+                    self.genomic.setdefault(key, []).append(row_idx)
+        for key, rules in ranges.items():
+            rules.sort()
+            ends = np.array([rule[1] for rule in rules], dtype=np.int64)
+            self.intervals[key] = {
+                "starts": np.array([rule[0] for rule in rules], dtype=np.int64),
+                "ends": ends,
+                # Largest end so far bounds how far back a lookup has to look
+                "max_ends": np.maximum.accumulate(ends),
+                "rows": [rule[2] for rule in rules],
+            }
+
+    def lookup(self, gene, mutation):
+        """Row indices of rules matching gene and mutation exactly"""
+        return self.exact.get((gene, mutation), [])
+
+    def lookup_genomic(self, chrom, pos, ref, alt):
+        """Row indices of rules matching a vcf style genomic variant"""
+        return self.genomic.get((chrom, pos, ref, alt), [])
+
+    def lookup_position(self, gene, kind, position):
+        """Row indices of range rules of kind ('missense_codon' or 'indel_nucleotide')
+        covering position in gene"""
+        intervals = self.intervals.get((gene, kind))
+        if intervals is None:
+            return []
+        rows = []
+        idx = int(np.searchsorted(intervals["starts"], position, side="right")) - 1
+        while idx >= 0 and intervals["max_ends"][idx] >= position:
+            if intervals["ends"][idx] >= position:
+                rows.append(intervals["rows"][idx])
+            idx -= 1
+        return rows[::-1]
+
+    def expand(self):
+        """Catalogue with every range rule expanded into one row per codon or nucleotide"""
+        rows = []
+        for row_idx, mutation in zip(self.df.index, self.df.Mutation):
+            rule_range = self.parse_range(mutation)
+            if rule_range is None:
+                rows.append((row_idx, mutation, False))
+            else:
+                kind, start, end = rule_range
+                rows.extend((row_idx, f"any_{kind}_{pos}", True) for pos in range(start, end + 1))
+        row_idxs, mutations, is_range = zip(*rows) if rows else ((), (), ())
+        expanded = self.df.loc[list(row_idxs)].reset_index(drop=True)
+        expanded['Mutation'] = list(mutations)
+        if 'Translation' in expanded:
+            # tbdb translates range rules to themselves
+            is_range = np.array(is_range, dtype=bool)
+            expanded.loc[is_range, 'Translation'] = expanded.Mutation[is_range]
+        return expanded
+
+    def write_flat_csv(self, csv_outpath):
+        """Write catalogue with range rules expanded per position"""
+        self.expand().to_csv(csv_outpath, index=False)
+
+    @staticmethod
+    def write_sqlite(source_fpaths, db_filepath):
+        """Write catalogue csv files into one sqlite catalogue table with a Source column and
+        an index on (Drug, Gene, Mutation), plus a sources table recording file checksums"""
+        frames = []
+        for source, csv_fpath in source_fpaths.items():
+            frame = pd.read_csv(csv_fpath, dtype=str)
+            frame['Source'] = source
+            frames.append(frame)
+        catalogue = pd.concat(frames, ignore_index=True)
+        sources = pd.DataFrame({
+            'Source': list(source_fpaths),
+            'File': [os.path.basename(csv_fpath) for csv_fpath in source_fpaths.values()],
+            'Sha256': [Utils.file_checksum(csv_fpath) for csv_fpath in source_fpaths.values()],
+            'Jasentool_Version': __version__,
+        })
+        tmp_filepath = f"{db_filepath}.tmp"
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        conn = sqlite3.connect(tmp_filepath)
+        try:
+            catalogue.to_sql('catalogue', conn, index=False)
+            sources.to_sql('sources', conn, index=False)
+            conn.execute('CREATE INDEX idx_drug_gene_mutation ON catalogue (Drug, Gene, Mutation)')
+            conn.execute('CREATE INDEX idx_gene_mutation ON catalogue (Gene, Mutation)')
+            conn.execute('CREATE INDEX idx_source ON catalogue (Source)')
+            conn.commit()
+        finally:
+            conn.close()
+        os.replace(tmp_filepath, db_filepath)
@@ -53,6 +53,11 @@ def __bed_file(group, required):
     """Add bed_file argument to group"""
     group.add_argument('--bed_file', required=required, type=str, help='input bed file')
 
+def __regions_file(group):
+    """Add regions_file argument to group"""
+    group.add_argument('--regions_file', type=str, default=None,
+                       help='bed or gff file of genes/regions to report coverage for')
+
 def __baits_file(group, required):
     """Add baits_file argument to group"""
     group.add_argument('--baits_file', required=required, type=str, default=None,
@@ -132,8 +137,9 @@ def __db_collection(group, required):
 
 def __out_format(group, required):
     """Add out_format argument to group"""
-    group.add_argument('-f', '--out_format', required=required, type=str,
-                       default="bed", help='output format')
+    group.add_argument('-f', '--out_format', required=required, type=str, default="bed",
+                       choices=['bed', 'sorted_bed', 'merged_bed', 'interval_list'],
+                       help='output format')
 
 def __accession(group, required):
     """Add accession argument to group"""
@@ -159,6 +165,27 @@ def __remote(group, required):
     group.add_argument('--remote', required=required, dest='remote', action='store_true',
                        default=False, help='remote copy')
 
+def __watch(group):
+    """Add watch argument to group"""
+    group.add_argument('--watch', dest='watch', action='store_true', default=False,
+                       help='keep running and fix each new sequencing run as it appears, \
+                        output files are prefixed with the run id')
+
+def __state_file(group):
+    """Add state_file argument to group"""
+    group.add_argument('--state_file', type=str, default='~/.jasentool/fix_watch_state.json',
+                       help='file recording sequencing runs already processed in watch mode')
+
+def __debounce(group):
+    """Add debounce argument to group"""
+    group.add_argument('--debounce', type=float, default=30.0,
+                       help='seconds the csv and sh files must be unchanged before processing')
+
+def __poll_interval(group):
+    """Add poll_interval argument to group"""
+    group.add_argument('--poll_interval', type=float, default=60.0,
+                       help='seconds between checks when inotify is unavailable')
+
 def __combined_output(group):
     """Add combined_output argument to group"""
     group.add_argument('--combined_output', dest='combined_output', action='store_true',
@@ -169,6 +196,21 @@ def __save_dbs(group):
     group.add_argument('--save_dbs', dest='save_dbs', action='store_true',
                        help='save all intermediary dbs created for TBProfiler db convergence')
 
+def __force(group):
+    """Add force argument to group"""
+    group.add_argument('--force', dest='force', action='store_true',
+                       help='rebuild all stages even if their inputs are unchanged')
+
+def __dry_run(group):
+    """Add dry_run argument to group"""
+    group.add_argument('--dry_run', dest='dry_run', action='store_true',
+                       help='print which stages would run and why, without running them')
+
+def __expand_ranges(group):
+    """Add expand_ranges argument to group"""
+    group.add_argument('--expand_ranges', dest='expand_ranges', action='store_true',
+                       help='also write a flat catalogue with codon/nucleotide ranges expanded per position')
+
 def __sample_sheet(group, required):
     """Add sample_sheet argument to group"""
     group.add_argument('--sample_sheet', required=required, dest='sample_sheet',
@@ -178,6 +220,40 @@ def __cpus(group):
     """Add cpus argument to group"""
     group.add_argument('--cpus', dest='cpus', type=int, default=2, help='input cpus')
 
+def __manifest(group, required):
+    """Add manifest argument to group"""
+    group.add_argument('--manifest', required=required, type=str,
+                       help='csv/tsv with sample_id, bam_file and optional bed_file, baits_file columns')
+
+def __workers(group):
+    """Add workers argument to group"""
+    group.add_argument('--workers', type=int, default=None,
+                       help='samples processed in parallel in batch mode, sharing --cpus \
+                        (default: cpus / 4)')
+
+def __timings(group):
+    """Add timings argument to group"""
+    group.add_argument('--timings', dest='timings', action='store_true', default=False,
+                       help='add wall and cpu time of each qc stage, plus cpu time and peak memory \
+                        of the whole process, to the output')
+
+def __engine(group):
+    """Add engine argument to group"""
+    group.add_argument('--engine', type=str, default='auto', choices=['auto', 'pysam', 'external'],
+                       help='compute read counts, insert sizes and depth in one pass with pysam \
+                        or with samtools/sambamba/picard (auto uses pysam if installed)')
+
+def __catalogue(group, required):
+    """Add catalogue argument to group"""
+    group.add_argument('--catalogue', required=required, type=str,
+                       help='path to converged mutation catalogue csv (from jasentool converge)')
+
+def __cache_dir(group):
+    """Add cache_dir argument to group"""
+    group.add_argument('--cache_dir', type=str, default=None,
+                       help='directory for cached files shared between runs \
+                        (default: $JASENTOOL_CACHE_DIR or ~/.cache/jasentool)')
+
 def __help(group):
     """Add help argument to group"""
     group.add_argument('-h', '--help', action='help', help='show help message')
@@ -244,12 +320,18 @@ def get_main_parser():
             __help(group)
 
     with subparser(sub_parsers, 'convert', 'Convert file format') as parser:
-        with arg_group(parser, 'required named arguments') as group:
-            __input_file(group, required=True, help='path to targets tsv file')
-            __output_file(group, required=True, help='path to mongo db output file')
+        with mutex_group(parser, required=True) as group:
+            __input_file(group, required=False, help='path to targets tsv file(s), may be gzipped')
+            __input_dir(group, required=False, help='path to directory containing targets tsv files')
+        with mutex_group(parser, required=True) as group:
+            __output_dir(group, required=False)
+            __output_file(group, required=False, help='path to converted output file')
         with arg_group(parser, 'optional arguments') as group:
             __out_format(group, required=False)
             __accession(group, required=False)
+            __reference(group, required=False,
+                        help='reference fasta or .dict file (required for interval_list)')
+            __cpus(group)
             __help(group)
 
     with subparser(sub_parsers, 'fix', 'Fix bjorn microbiology csv file') as parser:
@@ -262,24 +344,51 @@ def get_main_parser():
             __remote_hostname(group, required=False)
             __remote(group, required=False)
             __auto_start(group, required=False)
+            __watch(group)
+            __state_file(group)
+            __debounce(group)
+            __poll_interval(group)
             __help(group)
 
     with subparser(sub_parsers, 'converge', 'Converge TB mutation catalogues') as parser:
         with arg_group(parser, 'optional arguments') as group:
             __output_dir(group, required=False)
             __save_dbs(group)
+            __force(group)
+            __dry_run(group)
+            __expand_ranges(group)
+            __help(group)
+
+    with subparser(sub_parsers, 'annotate', 'Annotate variants with converged TB mutation catalogue') as parser:
+        with mutex_group(parser, required=True) as group:
+            __input_file(group, required=False, help='path to snpEff annotated vcf(s) or JASEN result json(s)')
+            __input_dir(group, required=False, help='path to directory containing vcf or result json files')
+        with arg_group(parser, 'required named arguments') as group:
+            __catalogue(group, required=True)
+            __output_file(group, required=True, help='path to annotation tsv output file')
+        with arg_group(parser, 'optional arguments') as group:
+            __cache_dir(group)
             __help(group)
 
     with subparser(sub_parsers, 'qc', 'Run qc on bwa alignment') as parser:
+        with mutex_group(parser, required=True) as group:
+            __bam_file(group, required=False)
+            __manifest(group, required=False)
+        with mutex_group(parser, required=True) as group:
+            __output_file(group, required=False, help='path to qc json output file')
+            __output_dir(group, required=False)
         with arg_group(parser, 'required named arguments') as group:
-            __sample_id(group, required=True)
-            __bam_file(group, required=True)
             __reference(group, required=True, help='reference fasta file')
-            __output_file(group, required=True, help='path to qc json output file')
         with arg_group(parser, 'optional arguments') as group:
+            __sample_id(group, required=False)
             __bed_file(group, required=False)
             __baits_file(group, required=False)
+            __regions_file(group)
             __cpus(group)
+            __workers(group)
+            __engine(group)
+            __timings(group)
+            __cache_dir(group)
             __help(group)
 
     return main_parser
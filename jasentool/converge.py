@@ -6,20 +6,27 @@ import pandas as pd
 from jasentool.who import WHO
 from jasentool.genome import Genome
 from jasentool.tbprofiler import Tbprofiler
-from jasentool.utils import Utils
+from jasentool.scheduler import TaskGraph
+from jasentool.build import Build
+from jasentool.catalogue import Catalogue
 
 class Converge:
     """Class that converges mutation catalogues"""
     def __init__(self, download_dir):
         self.download_dir = download_dir
+        # Downloads and intermediary dbs are kept here so unchanged stages can be skipped
+        self.build_dir = os.path.join(download_dir, ".converge")
+        self.manifest_fpath = os.path.join(self.build_dir, "build.json")
         self.fohm_fpath = os.path.join(os.path.dirname(__file__), "data/dbs/fohm.csv")
-        self.intersection_outfpath = os.path.join(download_dir, "intersection.csv")
+        self.intersection_outfpath = os.path.join(self.build_dir, "intersection.csv")
         self.unique_tbdb_outfpath = os.path.join(download_dir, "unique_tbdb.csv")
         self.unique_who_outfpath = os.path.join(download_dir, "unique_who.csv")
-        self.fohm_tbdb_outfpath = os.path.join(download_dir, "fohm_tbdb.csv")
+        self.fohm_tbdb_outfpath = os.path.join(self.build_dir, "fohm_tbdb.csv")
         self.convereged_outfpath = os.path.join(download_dir, "converged_who_fohm_tbdb.csv")
-        self.tbdb_filepath = os.path.join(download_dir, "tbdb.csv")
-        self.tbdb_url = "https://raw.githubusercontent.com/jodyphelan/tbdb/master/tbdb.csv"
+        self.flat_outfpath = os.path.join(download_dir, "converged_who_fohm_tbdb_flat.csv")
+        self.sqlite_outfpath = os.path.join(download_dir, "converged_who_fohm_tbdb.sqlite")
+        self.tbdb_filepath = os.path.join(self.build_dir, "tbdb.csv")
+        self.who_filepath = os.path.join(self.build_dir, "who.csv")
 
     def compare_columns(self, tbdb_df, who_df, column_names):
         """Return a list of all of the unique and common variants in each dataframe"""
@@ -49,42 +56,98 @@ class Converge:
         return intersection_df, unique_tbdb_df, unique_who_df
 
     def rm_intermediary_files(self):
-        files = os.listdir(self.download_dir)
-        for filename in ['converged_who_fohm_tbdb.csv', 'unique_tbdb.csv', 'unique_who.csv', 'fohm.csv']:
-            files.remove(filename)
-        for filename in files:
+        """Remove intermediary dbs saved to the output directory by earlier runs"""
+        for filename in os.listdir(self.build_dir):
             filepath = os.path.join(self.download_dir, filename)
             if os.path.isfile(filepath):
                 os.remove(filepath)
             elif os.path.isdir(filepath):
                 shutil.rmtree(filepath)
 
-    def run(self, save_all_dbs):
-        """Run the retrieval and convergance of mutation catalogues"""
-        utils = Utils()
-        # Download the genome
-        mycobacterium_genome = Genome("NC_000962.3", "AL123456.3", self.download_dir, "h37rv")
-        fasta_filepath = mycobacterium_genome.download_fasta()
-        gff_filepath = mycobacterium_genome.download_gff()
-        utils.download_and_save_file(self.tbdb_url, self.tbdb_filepath)
-        who = WHO()
-        tbprofiler = Tbprofiler(self.tbdb_filepath)
-        #h37rv_gb_filepath = mycobacterium_genome.download_genbank()
-        who_df = who._parse(fasta_filepath, gff_filepath, self.download_dir)
-        tbdb_df = tbprofiler._parse(self.download_dir)
-        #tbdb_df = pd.read_csv("/data/bnf/dev/ryan/pipelines/jasen/converge/tbdb.csv")
-        #who_df = pd.read_csv("/data/bnf/dev/ryan/pipelines/jasen/converge/who.csv")
-        fohm_df = pd.read_csv(self.fohm_fpath)
+    def save_intermediary_files(self):
+        """Copy intermediary dbs and downloads from the build directory to the output directory"""
+        for filename in os.listdir(self.build_dir):
+            filepath = os.path.join(self.build_dir, filename)
+            if os.path.isfile(filepath) and filepath != self.manifest_fpath:
+                shutil.copy(filepath, self.download_dir)
+
+    def get_downloads(self, genome, who, tbprofiler):
+        """Declare every remote input once, keyed by the name its parsers expect"""
+        return {
+            "fasta_filepath": genome.download_fasta,
+            "gff_filepath": genome.download_gff,
+            "who_filepath": lambda: who.download(self.build_dir),
+            "tbdb_filepath": lambda: tbprofiler.download(self.build_dir),
+            #"h37rv_gb_filepath": genome.download_genbank,
+        }
+
+    def compare(self, tbprofiler, genome):
+        """Split tbdb and WHO catalogues into common and unique variants"""
+        tbdb_df = tbprofiler._parse(self.build_dir, self.tbdb_filepath,
+                                    genome.fasta_filepath, genome.gff_filepath)
+        who_df = pd.read_csv(self.who_filepath)
         column_names = ['Drug', 'Gene', 'Mutation']
         intersection_df, unique_tbdb_df, unique_who_df = self.compare_columns(tbdb_df, who_df, column_names)
-        dfs_to_concat = [intersection_df, unique_tbdb_df, fohm_df]
-        fohm_tbdb_df = pd.concat(dfs_to_concat, ignore_index=True).drop_duplicates()
         intersection_df.to_csv(self.intersection_outfpath, index=False)
         unique_tbdb_df.to_csv(self.unique_tbdb_outfpath, index=False)
         unique_who_df.to_csv(self.unique_who_outfpath, index=False)
-        fohm_tbdb_df.to_csv(self.fohm_tbdb_outfpath, index=False)
-        dfs_to_converge = [intersection_df, unique_tbdb_df, unique_who_df, fohm_df]
-        converged_df = pd.concat(dfs_to_converge, ignore_index=True).drop_duplicates()
-        converged_df.to_csv(self.convereged_outfpath, index=False)
-        if not save_all_dbs:
+
+    def concat(self, csv_fpaths, outfpath):
+        """Concatenate catalogue csv files without duplicates"""
+        dfs_to_concat = [pd.read_csv(csv_fpath) for csv_fpath in csv_fpaths]
+        concat_df = pd.concat(dfs_to_concat, ignore_index=True).drop_duplicates()
+        concat_df.to_csv(outfpath, index=False)
+
+    def run(self, save_all_dbs, force=False, dry_run=False, expand_ranges=False):
+        """Run the retrieval and convergance of mutation catalogues, skipping stages whose
+        inputs are unchanged since the last run. Codon and nucleotide range rules are only
+        expanded per position in an extra flat csv if expand_ranges is set"""
+        os.makedirs(self.build_dir, exist_ok=True)
+        build = Build(self.manifest_fpath, force, dry_run)
+        mycobacterium_genome = Genome("NC_000962.3", "AL123456.3", self.build_dir, "h37rv")
+        who = WHO()
+        tbprofiler = Tbprofiler(self.build_dir)
+        downloads = self.get_downloads(mycobacterium_genome, who, tbprofiler)
+        who_xlsx_fpath = os.path.join(self.build_dir, "who.xlsx")
+        if dry_run:
+            # Downloads are conditional requests, so they are always checked
+            for name in downloads:
+                build.plan.append((name, "check", "conditional download"))
+            build.stage("who", None, [who_xlsx_fpath], [self.who_filepath])
+        else:
+            # Fetch all downloads concurrently, the WHO catalogue is parsed as soon as it arrives
+            graph = TaskGraph(len(downloads))
+            for name, download in downloads.items():
+                graph.add(name, download)
+            graph.add("who", lambda who_filepath: build.stage(
+                "who", lambda: who._parse(mycobacterium_genome.fasta_filepath,
+                                          mycobacterium_genome.gff_filepath,
+                                          self.build_dir, who_filepath),
+                [who_filepath], [self.who_filepath]), deps=("who_filepath",))
+            graph.run()
+        build.stage("compare", lambda: self.compare(tbprofiler, mycobacterium_genome),
+                    [self.tbdb_filepath, self.who_filepath, mycobacterium_genome.fasta_filepath,
+                     mycobacterium_genome.gff_filepath],
+                    [self.intersection_outfpath, self.unique_tbdb_outfpath,
+                     self.unique_who_outfpath])
+        fohm_tbdb_inputs = [self.intersection_outfpath, self.unique_tbdb_outfpath, self.fohm_fpath]
+        build.stage("fohm_tbdb", lambda: self.concat(fohm_tbdb_inputs, self.fohm_tbdb_outfpath),
+                    fohm_tbdb_inputs, [self.fohm_tbdb_outfpath])
+        converge_inputs = [self.intersection_outfpath, self.unique_tbdb_outfpath,
+                           self.unique_who_outfpath, self.fohm_fpath]
+        build.stage("converge", lambda: self.concat(converge_inputs, self.convereged_outfpath),
+                    converge_inputs, [self.convereged_outfpath])
+        # Sources: who_tbdb are rows in both catalogues, tbdb/who rows unique to either one
+        sqlite_sources = {"who_tbdb": self.intersection_outfpath, "tbdb": self.unique_tbdb_outfpath,
+                          "who": self.unique_who_outfpath, "fohm": self.fohm_fpath}
+        build.stage("sqlite", lambda: Catalogue.write_sqlite(sqlite_sources, self.sqlite_outfpath),
+                    list(sqlite_sources.values()), [self.sqlite_outfpath])
+        if expand_ranges:
+            build.stage("flat", lambda: Catalogue.read_csv(self.convereged_outfpath).write_flat_csv(
+                self.flat_outfpath), [self.convereged_outfpath], [self.flat_outfpath])
+        if dry_run:
+            build.print_plan()
+        elif save_all_dbs:
+            self.save_intermediary_files()
+        else:
             self.rm_intermediary_files()
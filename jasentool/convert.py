@@ -1,18 +1,191 @@
 """Module that converts file type"""
 
+import os
+import gzip
+import heapq
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 class Convert:
     """Convert class for converting files into desired format"""
+    out_formats = {
+        "bed": ".bed",
+        "sorted_bed": ".bed",
+        "merged_bed": ".bed",
+        "interval_list": ".interval_list",
+    }
+
     @staticmethod
-    def targets2bed(target_file, accn):
-        """Convert cgmlst locus targets to bed file format"""
-        bed_output = ""
-        with open(target_file, 'r', encoding="utf-8") as fin:
+    def open_text(filepath, mode='r'):
+        """Open plain or gzipped text file"""
+        if filepath.endswith(".gz"):
+            return gzip.open(filepath, mode + 't', encoding="utf-8")
+        return open(filepath, mode, encoding="utf-8")
+
+    @staticmethod
+    def find_target_files(input_dir):
+        """Find cgmlst.org target files in directory"""
+        return sorted(os.path.join(input_dir, filename) for filename in os.listdir(input_dir)
+                      if filename.endswith((".tsv", ".tsv.gz")))
+
+    @staticmethod
+    def get_output_fpath(output_prefix, out_format):
+        """Get output filepath with the extension of the output format"""
+        if output_prefix.endswith(".tsv"):
+            output_prefix = os.path.splitext(output_prefix)[0]
+        return output_prefix + Convert.out_formats[out_format]
+
+    @staticmethod
+    def read_targets(target_file):
+        """Stream (start, end, locus) of cgmlst locus targets, start is 0-based"""
+        with Convert.open_text(target_file) as fin:
             for line in fin:
                 if line.startswith("Locus"):
                     continue
                 line_split = line.split("\t")
                 start = int(line_split[3]) - 1
                 length = int(line_split[4])
-                end = start + length
-                bed_output += f"{accn}\t{start}\t{end}\n"
-        return bed_output
+                yield start, start + length, line_split[0]
+
+    @staticmethod
+    def sort_intervals(intervals, chunk_size=200000):
+        """Sort intervals by start using sorted on-disk chunks so memory stays bounded"""
+        chunk_files = []
+        try:
+            chunk = []
+            for interval in intervals:
+                chunk.append(interval)
+                if len(chunk) >= chunk_size:
+                    chunk_files.append(Convert._write_chunk(sorted(chunk)))
+                    chunk = []
+            if not chunk_files:
+                yield from sorted(chunk)
+                return
+            if chunk:
+                chunk_files.append(Convert._write_chunk(sorted(chunk)))
+            yield from heapq.merge(*(Convert._read_chunk(chunk_file) for chunk_file in chunk_files))
+        finally:
+            for chunk_file in chunk_files:
+                os.remove(chunk_file)
+
+    @staticmethod
+    def _write_chunk(intervals):
+        """Write sorted intervals to a temporary file"""
+        with tempfile.NamedTemporaryFile('w', suffix=".intervals", delete=False,
+                                         encoding="utf-8") as fout:
+            for start, end, name in intervals:
+                fout.write(f"{start}\t{end}\t{name}\n")
+        return fout.name
+
+    @staticmethod
+    def _read_chunk(chunk_file):
+        """Stream intervals back from a temporary chunk file"""
+        with open(chunk_file, 'r', encoding="utf-8") as fin:
+            for line in fin:
+                start, end, name = line.rstrip("\n").split("\t")
+                yield int(start), int(end), name
+
+    @staticmethod
+    def merge_intervals(sorted_intervals):
+        """Merge overlapping or book-ended sorted intervals"""
+        current = None
+        for start, end, name in sorted_intervals:
+            if current and start <= current[1]:
+                current[1] = max(current[1], end)
+                continue
+            if current:
+                yield tuple(current)
+            current = [start, end, name]
+        if current:
+            yield tuple(current)
+
+    @staticmethod
+    def read_sequence_dict(dict_file):
+        """Get @SQ lines and contig names from a sequence dictionary (.dict)"""
+        sq_lines = []
+        with open(dict_file, 'r', encoding="utf-8") as fin:
+            for line in fin:
+                if line.startswith("@SQ"):
+                    sq_lines.append(line.rstrip("\n"))
+        contigs = [field[3:] for line in sq_lines for field in line.split("\t")
+                   if field.startswith("SN:")]
+        return sq_lines, contigs
+
+    @staticmethod
+    def get_dict_file(reference):
+        """Get sequence dictionary path from a fasta or .dict path"""
+        if reference.endswith(".dict"):
+            return reference
+        if os.path.isfile(f"{reference}.dict"):
+            return f"{reference}.dict"
+        return os.path.splitext(reference)[0] + ".dict"
+
+    @staticmethod
+    def write_bed(intervals, accn, fout):
+        """Write intervals as bed rows"""
+        for start, end, _ in intervals:
+            fout.write(f"{accn}\t{start}\t{end}\n")
+
+    @staticmethod
+    def read_bed(bed_file):
+        """Stream (chrom, start, end, strand, name) from a (gzipped) bed file"""
+        with Convert.open_text(bed_file) as fin:
+            for line in fin:
+                if line.startswith(("#", "track", "browser")) or not line.strip():
+                    continue
+                fields = line.rstrip("\n").split("\t")
+                name = fields[3] if len(fields) > 3 else "."
+                strand = fields[5] if len(fields) > 5 and fields[5] in "+-" else "+"
+                yield fields[0], int(fields[1]), int(fields[2]), strand, name
+
+    @staticmethod
+    def write_interval_list(rows, sq_lines, fout):
+        """Write (chrom, start, end, strand, name) rows as Picard interval_list (1-based, closed)"""
+        fout.write("@HD\tVN:1.6\tSO:coordinate\n")
+        for sq_line in sq_lines:
+            fout.write(f"{sq_line}\n")
+        for chrom, start, end, strand, name in rows:
+            fout.write(f"{chrom}\t{start + 1}\t{end}\t{strand}\t{name or '.'}\n")
+
+    @staticmethod
+    def bed2interval_list(bed_file, dict_file, fout):
+        """Convert bed to interval_list sorted in sequence dictionary order, like BedToIntervalList"""
+        sq_lines, contigs = Convert.read_sequence_dict(dict_file)
+        contig_order = {contig: idx for idx, contig in enumerate(contigs)}
+        rows = []
+        for row in Convert.read_bed(bed_file):
+            if row[0] not in contig_order:
+                raise ValueError(f"{row[0]} in {bed_file} is not in sequence dictionary {dict_file}")
+            rows.append(row)
+        rows.sort(key=lambda row: (contig_order[row[0]], row[1], row[2]))
+        Convert.write_interval_list(rows, sq_lines, fout)
+
+    @staticmethod
+    def targets2bed(target_file, output_fpath, accn, out_format="bed", dict_file=None):
+        """Stream cgmlst locus targets into bed, sorted/merged bed or interval_list"""
+        intervals = Convert.read_targets(target_file)
+        if out_format in ("sorted_bed", "merged_bed", "interval_list"):
+            intervals = Convert.sort_intervals(intervals)
+        if out_format == "merged_bed":
+            intervals = Convert.merge_intervals(intervals)
+        with Convert.open_text(output_fpath, 'w') as fout:
+            if out_format == "interval_list":
+                sq_lines, _ = Convert.read_sequence_dict(dict_file)
+                rows = ((accn, start, end, "+", name) for start, end, name in intervals)
+                Convert.write_interval_list(rows, sq_lines, fout)
+            else:
+                Convert.write_bed(intervals, accn, fout)
+        return output_fpath
+
+    @staticmethod
+    def convert_targets(target_files, output_fpaths, accn, out_format="bed",
+                        dict_file=None, cpus=1):
+        """Convert several target files in parallel"""
+        if len(target_files) == 1 or cpus <= 1:
+            return [Convert.targets2bed(target_file, output_fpath, accn, out_format, dict_file)
+                    for target_file, output_fpath in zip(target_files, output_fpaths)]
+        with ProcessPoolExecutor(max_workers=min(cpus, len(target_files))) as executor:
+            futures = [executor.submit(Convert.targets2bed, target_file, output_fpath,
+                                       accn, out_format, dict_file)
+                       for target_file, output_fpath in zip(target_files, output_fpaths)]
+            return [future.result() for future in futures]
@@ -0,0 +1,114 @@
+"""Module for conditional, content-addressed caching of downloads"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from time import sleep
+import requests
+from jasentool.cache import Cache
+from jasentool.utils import Utils
+
+class DownloadCache:
+    """Class that revalidates cached downloads with ETag/Last-Modified before fetching them"""
+    chunk_size = 1024 * 1024
+
+    def __init__(self, cache_dir=None):
+        self.cache = Cache(cache_dir)
+
+    def meta_path(self, url):
+        """Path of the metadata (etag, last modified, checksum) stored for url"""
+        url_key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return self.cache.get_path("downloads", "urls", f"{url_key}.json")
+
+    def object_path(self, checksum):
+        """Path of the cached bytes with the given sha256 checksum"""
+        return self.cache.get_path("downloads", "objects", checksum)
+
+    def read_meta(self, url):
+        """Read the cached metadata of url if its bytes are still in the cache"""
+        meta_filepath = self.meta_path(url)
+        if not os.path.isfile(meta_filepath):
+            return None
+        with open(meta_filepath, 'r', encoding="utf-8") as fin:
+            meta = json.load(fin)
+        return meta if os.path.isfile(self.object_path(meta["sha256"])) else None
+
+    def write_meta(self, url, meta):
+        """Store metadata of url"""
+        with self.cache.atomic_write(self.meta_path(url)) as fout:
+            json.dump(meta, fout)
+
+    def conditional_headers(self, meta):
+        """Request headers that let the server answer 304 if nothing changed"""
+        headers = {}
+        if meta and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta and meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def store(self, response):
+        """Stream response into the object store and return its checksum"""
+        digest = hashlib.sha256()
+        objects_dir = os.path.dirname(self.object_path("_"))
+        fd, tmp_filepath = tempfile.mkstemp(dir=objects_dir, prefix=".tmp_")
+        try:
+            with os.fdopen(fd, 'wb') as fout:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    digest.update(chunk)
+                    fout.write(chunk)
+            checksum = digest.hexdigest()
+            os.replace(tmp_filepath, self.object_path(checksum))
+        except BaseException:
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            raise
+        return checksum
+
+    def materialise(self, checksum, output_filepath):
+        """Atomically place cached bytes at output_filepath unless they are already there"""
+        object_filepath = self.object_path(checksum)
+        if os.path.isfile(output_filepath) and \
+                os.path.getsize(output_filepath) == os.path.getsize(object_filepath) and \
+                Utils.file_checksum(output_filepath) == checksum:
+            return
+        with self.cache.atomic_write(output_filepath, 'wb') as fout, \
+                open(object_filepath, 'rb') as fin:
+            shutil.copyfileobj(fin, fout, self.chunk_size)
+
+    def fetch(self, url, output_filepath, timeout=60):
+        """Fetch url to output_filepath, reusing cached bytes if the server answers 304"""
+        meta = self.read_meta(url)
+        with requests.get(url, stream=True, timeout=timeout,
+                          headers=self.conditional_headers(meta)) as response:
+            if response.status_code == 304 and meta:
+                self.materialise(meta["sha256"], output_filepath)
+                print(f"File unchanged, reused cached copy: {output_filepath}")
+                return output_filepath
+            response.raise_for_status()  # Raise an error for bad responses
+            checksum = self.store(response)
+            self.write_meta(url, {
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "sha256": checksum,
+            })
+        self.materialise(checksum, output_filepath)
+        print(f"File downloaded and saved to: {output_filepath}")
+        return output_filepath
+
+    def download(self, url, output_filepath, timeout=60, retries=3):
+        """Fetch url with retries and backoff on transient failures"""
+        for attempt in range(1, retries + 1):
+            try:
+                return self.fetch(url, output_filepath, timeout)
+            except requests.exceptions.RequestException as error_code:
+                print(f"Error downloading the file (attempt {attempt}/{retries}): {error_code}")
+                response = getattr(error_code, "response", None)
+                # Client errors will not go away by retrying
+                if attempt == retries or (response is not None and response.status_code < 500):
+                    raise
+                sleep(2 ** attempt)
+        return output_filepath
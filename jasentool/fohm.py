@@ -2,26 +2,31 @@
 
 import os
 import pandas as pd
-from openpyxl import load_workbook
+from jasentool.cache import Cache
+from jasentool.workbook import Workbook
 
 class Fohm:
     """Class for processing FoHM TB mutation catalogue"""
-    def __init__(self, download_dir):
+    def __init__(self, download_dir, cache_dir=None):
         self.download_dir = download_dir
+        self.cache = Cache(cache_dir)
         self.fohm_filepath = os.path.join(download_dir, "fohm.csv")
 
     def convert_colour(self, excel_filepath):
         """Convert coloured cells to hex value"""
-        excel_catalogue = load_workbook(excel_filepath, data_only = True)
-        mutation_sheet = excel_catalogue['Sheet1']
-        color_in_hex = mutation_sheet['A2'].fill.start_color.index
+        catalogue = Workbook.read_sheet(excel_filepath, 'Sheet1', fill_columns=[0])
+        color_in_hex = catalogue.iloc[0, -1]
         print ('HEX =', color_in_hex)
-        print('RGB =', tuple(int(color_in_hex[i:i+2], 16) for i in (0, 2, 4))) # Color in RGB
+        print('RGB =', tuple(int(color_in_hex[i:i+2], 16) for i in (2, 4, 6))) # Color in RGB
 
     def read_file(self, csv_filepath, xlsx_filepath):
-        """Read excel and csv files"""
-        catalogue = pd.read_csv(csv_filepath, header=True)
-        catalogue = pd.read_excel(xlsx_filepath, sheet_name='Mutation_catalogue', header=[0,1]).set_index([('variant (common_name)', 'Unnamed: 2_level_1')])
+        """Read excel and csv files, keeping the variant cell fill colours"""
+        catalogue = pd.read_csv(csv_filepath, header=0)
+        variant_column = ('variant (common_name)', 'Unnamed: 2_level_1')
+        # The excel parse is slow, so the parsed workbook is cached per source file
+        catalogue = self.cache.cached("fohm", lambda: Workbook.read_sheet(
+            xlsx_filepath, 'Mutation_catalogue', header=[0, 1],
+            fill_columns=[variant_column]).set_index([variant_column]), xlsx_filepath)
         return catalogue
 
     def convert2hgvs(self, mutation):
@@ -39,5 +44,5 @@ class Fohm:
 
     def _parse(self):
         """Parse the mutation catalogue"""
-        catalogue = pd.read_csv(self.fohm_filepath, header=True)
+        catalogue = pd.read_csv(self.fohm_filepath, header=0)
         catalogue['Mutation'] = catalogue.Mutation.apply(self.convert2hgvs)
@@ -1,67 +1,115 @@
 """Module for genomes and files related to the genomes"""
 
 import os
-from Bio import Entrez, SeqIO
+import shutil
+import zipfile
+from time import sleep
+import requests
+from jasentool.cache import Cache
+from jasentool.reference import FastaIndexer
 from jasentool.utils import Utils
 
 class Genome:
     """Class for handling genome download in multiple formats (fasta, genbank, gff) from NCBI"""
-    def __init__(self, refseq_accn, genbank_accn, download_dir, prefix, email="rjkennedyy@gmail.com"):
-        Entrez.email = email
+    assembly_accn = "GCF_000195955.2"
+    gff_member = f"ncbi_dataset/data/{assembly_accn}/genomic.gff"
+    efetch_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+
+    def __init__(self, refseq_accn, genbank_accn, download_dir, prefix,
+                 email="rjkennedyy@gmail.com", cache_dir=None, timeout=60, retries=3):
+        self.email = email
+        self.timeout = timeout
+        self.retries = retries
         self.refseq_accn = refseq_accn
         self.genbank_accn = genbank_accn
         self.download_dir = download_dir
-        self.zip_filepath = os.path.join(download_dir, "GCF_000195955.2.zip")
+        self.cache = Cache(cache_dir)
+        self.zip_filepath = os.path.join(download_dir, f"{self.assembly_accn}.zip")
         self.fasta_filepath = os.path.join(download_dir, f"{prefix}.fasta")
         self.genbank_filepath = os.path.join(download_dir, f"{prefix}.gb")
         self.gff_filepath = os.path.join(download_dir, f"{prefix}.gff")
 
-    def download_fasta(self):
-        """Download genome in fasta format"""
-        try:
-            # Fetch the fasta record from NCBI
-            fasta_handle = Entrez.efetch(db="nucleotide", id=self.refseq_accn,
-                                         rettype="fasta", retmode="text")
-            fasta_record = SeqIO.read(fasta_handle, "fasta")
-            fasta_handle.close()
+    @staticmethod
+    def iter_lines(chunks):
+        """Split a stream of byte chunks into lines, keeping their line endings"""
+        remainder = b""
+        for chunk in chunks:
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+        if remainder:
+            yield remainder
 
-            # Save the fasta record to a file
-            SeqIO.write(fasta_record, self.fasta_filepath, "fasta")
+    def stream_efetch(self, accn, rettype, output_filepath, indexer_factory=None):
+        """Stream raw Entrez efetch lines of accn to output_filepath, feeding them to a new
+        indexer_factory() indexer on the way so no record is parsed or held in memory.
+        Transient failures are retried with backoff, returns the indexer"""
+        params = {"db": "nucleotide", "id": accn, "rettype": rettype, "retmode": "text",
+                  "tool": "jasentool", "email": self.email}
+        for attempt in range(1, self.retries + 1):
+            indexer = indexer_factory() if indexer_factory else None
+            try:
+                with requests.get(self.efetch_url, params=params, stream=True,
+                                  timeout=self.timeout) as response:
+                    response.raise_for_status()
+                    with Cache.atomic_write(output_filepath, 'wb') as fout:
+                        for line in self.iter_lines(response.iter_content(1024 * 1024)):
+                            fout.write(line)
+                            if indexer is not None:
+                                indexer.add(line)
+                return indexer
+            except requests.exceptions.RequestException as error_code:
+                print(f"Error fetching {accn} (attempt {attempt}/{self.retries}): {error_code}")
+                response = getattr(error_code, "response", None)
+                # Client errors will not go away by retrying
+                if attempt == self.retries or (response is not None and
+                                               response.status_code < 500):
+                    raise
+                sleep(2 ** attempt)
+        return None
 
-            print(f"Fasta downloaded and saved to {self.fasta_filepath}")
+    def cached_efetch(self, accn, rettype, extension):
+        """Cached copy of accn in rettype format, only fetched from NCBI on a cache miss.
+        Versioned accessions (e.g. NC_000962.3) never change, so the cache is keyed by them"""
+        cache_filepath = self.cache.get_path("genomes", f"{accn}.{extension}")
+        fai_filepath = f"{cache_filepath}.fai"
+        if os.path.isfile(cache_filepath) and (rettype != "fasta" or os.path.isfile(fai_filepath)):
+            return cache_filepath
+        if rettype == "fasta":
+            indexer = self.stream_efetch(accn, rettype, cache_filepath, FastaIndexer)
+            # The index is written after the fasta so it is never considered stale
+            FastaIndexer.write_index(indexer.index, fai_filepath)
+        else:
+            self.stream_efetch(accn, rettype, cache_filepath)
+        return cache_filepath
 
-        except Exception as error_code:
-            print(f"Error downloading the genome: {error_code}")
+    def download_fasta(self):
+        """Download genome in fasta format together with its .fai index, raising on failure"""
+        cache_filepath = self.cached_efetch(self.refseq_accn, "fasta", "fasta")
+        shutil.copyfile(cache_filepath, self.fasta_filepath)
+        shutil.copyfile(f"{cache_filepath}.fai", f"{self.fasta_filepath}.fai")
+        print(f"Fasta downloaded and saved to {self.fasta_filepath}")
         return self.fasta_filepath
 
     def download_genbank(self):
-        """Download genome in fasta format"""
-        try:
-            # Fetch the GenBank record from NCBI
-            genbank_handle = Entrez.efetch(db="nucleotide", id=self.genbank_accn,
-                                           rettype="gb", retmode="text")
-            genbank_record = SeqIO.read(genbank_handle, "genbank")
-            genbank_handle.close()
-
-            # Save the GenBank record to a file
-            SeqIO.write(genbank_record, self.genbank_filepath, "genbank")
-
-            print(f"Genbank file downloaded and saved to {self.genbank_filepath}")
-
-        except Exception as error_code:
-            print(f"Error downloading the genbank file: {error_code}")
+        """Download genome in genbank format, raising on failure"""
+        cache_filepath = self.cached_efetch(self.genbank_accn, "gb", "gb")
+        shutil.copyfile(cache_filepath, self.genbank_filepath)
+        print(f"Genbank file downloaded and saved to {self.genbank_filepath}")
         return self.genbank_filepath
 
     def download_gff(self):
-        """Download gff of genome genes"""
-        utils = Utils()
-        h37rv_url = "https://api.ncbi.nlm.nih.gov/datasets/v2alpha/genome/accession/GCF_000195955.2/download?include_annotation_type=GENOME_GFF&filename=GCF_000195955.2.zip"
-        try:
-            utils.download_and_save_file(h37rv_url, self.zip_filepath)
-            utils.unzip(self.zip_filepath, self.download_dir)
-            source = os.path.join(self.download_dir, "ncbi_dataset/data/GCF_000195955.2/genomic.gff")
-            destination = os.path.join(self.download_dir, "h37rv.gff")
-            utils.copy_file(source, destination)
-        except Exception as error_code:
-            print(f"Error downloading the gff file: {error_code}")
+        """Download gff of genome genes, raising on failure"""
+        h37rv_url = f"https://api.ncbi.nlm.nih.gov/datasets/v2alpha/genome/accession/{self.assembly_accn}/download?include_annotation_type=GENOME_GFF&filename={self.assembly_accn}.zip"
+        cache_filepath = self.cache.get_path("genomes", f"{self.assembly_accn}.gff")
+        if not os.path.isfile(cache_filepath):
+            Utils.download_and_save_file(h37rv_url, self.zip_filepath, self.timeout,
+                                         self.retries, cache_dir=self.cache.cache_dir)
+            # Stream the gff member out of the archive instead of extracting everything
+            with zipfile.ZipFile(self.zip_filepath) as archive, \
+                    archive.open(self.gff_member) as fin, \
+                    Cache.atomic_write(cache_filepath, 'wb') as fout:
+                shutil.copyfileobj(fin, fout, 1024 * 1024)
+        shutil.copyfile(cache_filepath, self.gff_filepath)
         return self.gff_filepath
@@ -0,0 +1,93 @@
+"""Module for indexing gene features of GFF3 files"""
+
+from jasentool.cache import Cache
+from jasentool.convert import Convert
+
+class Feature:
+    """Compact record of a GFF feature, also readable as feature['start'] etc."""
+    __slots__ = ('seqid', 'type', 'biotype', 'start', 'end', 'strand', 'name', 'locus_tag')
+
+    def __init__(self, seqid, feature_type, biotype, start, end, strand, name, locus_tag):
+        self.seqid = seqid
+        self.type = feature_type
+        self.biotype = biotype
+        self.start = start
+        self.end = end
+        self.strand = strand
+        self.name = name
+        self.locus_tag = locus_tag
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def reverse(self):
+        """1 if the feature is on the reverse strand, otherwise 0"""
+        return 1 if self.strand == '-' else 0
+
+    @property
+    def length(self):
+        """Feature length in bases"""
+        return self.end - self.start + 1
+
+class GffIndex:
+    """Class that streams a GFF3 file into features keyed by both name and locus tag"""
+    feature_types = ('gene', 'pseudogene')
+
+    def __init__(self, features):
+        self.features = features
+        self.lookup = {}
+        for feature in features:
+            for key in (feature.locus_tag, feature.name):
+                if key:
+                    self.lookup[key] = feature
+
+    def __contains__(self, key):
+        return key in self.lookup
+
+    def __getitem__(self, key):
+        return self.lookup[key]
+
+    def get(self, key, default=None):
+        """Get feature by name or locus tag"""
+        return self.lookup.get(key, default)
+
+    def coordinates(self, key):
+        """Get 1-based (start, end, strand) of a feature by name or locus tag"""
+        feature = self.lookup[key]
+        return feature.start, feature.end, feature.strand
+
+    @staticmethod
+    def parse_attributes(attributes):
+        """Parse the GFF3 attribute column into a dictionary"""
+        return dict(field.split('=', 1) for field in attributes.split(';') if '=' in field)
+
+    @classmethod
+    def parse(cls, gff_filepath, feature_types=None):
+        """Stream GFF3 file keeping only the wanted feature types"""
+        feature_types = set(feature_types or cls.feature_types)
+        features = []
+        with Convert.open_text(gff_filepath) as fin:
+            for line in fin:
+                if line.startswith('#'):
+                    if line.startswith('##FASTA'):
+                        break
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 9 or fields[2] not in feature_types:
+                    continue
+                attributes = cls.parse_attributes(fields[8])
+                features.append(Feature(
+                    fields[0], fields[2], attributes.get('gene_biotype', fields[2]),
+                    int(fields[3]), int(fields[4]), fields[6],
+                    attributes.get('Name') or attributes.get('gene'), attributes.get('locus_tag')))
+        return cls(features)
+
+    @classmethod
+    def load(cls, gff_filepath, feature_types=None, cache_dir=None):
+        """Load index from the cache keyed by the GFF content hash, parsing only on a miss"""
+        feature_types = tuple(sorted(feature_types or cls.feature_types))
+        features = Cache(cache_dir).cached(
+            "gff", lambda: cls.parse(gff_filepath, feature_types).features,
+            gff_filepath, extra=','.join(feature_types))
+        return cls(features)
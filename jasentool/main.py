@@ -12,7 +12,11 @@ from jasentool.missing import Missing
 from jasentool.convert import Convert
 from jasentool.fix import Fix
 from jasentool.converge import Converge
+from jasentool.annotate import Annotate
 from jasentool.qc import QC
+from jasentool.qc_batch import QCBatch
+from jasentool.transfer import Transfer
+from jasentool.watch import Watch
 
 class OptionsParser:
     """Class that parses through cli arguments and executes respective modules"""
@@ -111,33 +115,84 @@ class OptionsParser:
 
     def convert(self, options):
         """Execute conversion of file formats"""
-        utils = Utils()
         convert = Convert()
-        input_file = options.input_file[0]
-        output_fpath = os.path.splitext(options.output_file)[0] + "." + options.out_format
-        in_format = os.path.splitext(input_file)[1].lstrip(".")
-        if in_format == "tsv" and options.out_format == "bed":
-            output_txt = convert.targets2bed(input_file, options.accession)
-            utils.write_out_txt(output_txt, output_fpath)
+        if options.input_dir:
+            input_files = convert.find_target_files(options.input_dir)
+        else:
+            input_files = options.input_file
+        output_fpaths = self._get_output_fpaths(input_files, options.output_dir,
+                                                options.output_file, "", False)
+        output_fpaths = [convert.get_output_fpath(output_fpath, options.out_format)
+                         for output_fpath in output_fpaths]
+        dict_file = convert.get_dict_file(options.reference) if options.reference else None
+        accession = options.accession
+        if options.out_format == "interval_list":
+            if not dict_file:
+                print('ERROR: interval_list output requires a sequence dictionary. Use --reference.')
+                sys.exit(1)
+            contigs = convert.read_sequence_dict(dict_file)[1]
+            accession = accession or (contigs[0] if len(contigs) == 1 else None)
+        if not accession:
+            print('ERROR: No accession could be determined. Use --accession.')
+            sys.exit(1)
+        if options.output_dir:
+            os.makedirs(os.path.expanduser(options.output_dir), exist_ok=True)
+        convert.convert_targets(input_files, output_fpaths, accession, options.out_format,
+                                dict_file, options.cpus)
 
-    def fix(self, options):
-        """Execute fixing of file to desired format(s)"""
+    def _fix_run(self, options, output_file):
+        """Fix csv and sh files for one run and copy/start them if requested"""
         utils = Utils()
         fix = Fix()
-        csv_files, assays = fix.fix_csv(options.csv_file, options.output_file)
-        batch_files = fix.fix_sh(options.sh_file, options.output_file, assays)
+        csv_files, assays = fix.fix_csv(options.csv_file, output_file)
+        batch_files = fix.fix_sh(options.sh_file, output_file, assays)
         if (options.remote or options.auto_start) and batch_files:
-            utils.copy_batch_and_csv_files(batch_files, csv_files, options.remote_dir, options.remote_hostname, options.auto_start or options.remote)
+            transfer = Transfer(options.remote_dir, options.remote_hostname, options.auto_start or options.remote)
+            copied_files = transfer.sync(batch_files + csv_files)
             if options.auto_start:
-                utils.start_remote_pipelines(batch_files, options.remote_dir)
+                # Only (re)start pipelines whose batch files actually changed
+                changed_batch_files = [fpath for fpath in batch_files if fpath in copied_files]
+                utils.start_remote_pipelines(changed_batch_files, options.remote_hostname,
+                                             options.remote_dir)
+
+    def fix(self, options):
+        """Execute fixing of file to desired format(s)"""
+        if not options.watch:
+            self._fix_run(options, options.output_file)
+            return
+        output_dir, output_fname = os.path.split(options.output_file)
+        watch = Watch(options.csv_file, options.sh_file, options.state_file,
+                      options.debounce, options.poll_interval)
+        watch.run(lambda run_id: self._fix_run(
+            options, os.path.join(output_dir, f"{run_id}_{output_fname}")))
 
     def converge(self, options):
         """Execute convergence of mutation catalogues"""
         converge = Converge(options.output_dir)
-        converge.run(options.save_dbs)
+        converge.run(options.save_dbs, options.force, options.dry_run, options.expand_ranges)
+
+    def annotate(self, options):
+        """Execute annotation of variants with the converged mutation catalogue"""
+        if options.input_dir:
+            input_files = Annotate.find_input_files(options.input_dir)
+        else:
+            input_files = options.input_file
+        annotate = Annotate(options.catalogue, options.cache_dir)
+        annotate.run(input_files, options.output_file)
 
     def qc(self, options):
         """Execute retrieval of qc results"""
+        if options.manifest:
+            if not options.output_dir:
+                print('ERROR: Batch QC with --manifest requires --output_dir.')
+                sys.exit(1)
+            _, failed = QCBatch(options).run(options.manifest)
+            if failed:
+                sys.exit(1)
+            return
+        if not options.sample_id or not options.output_file:
+            print('ERROR: QC of a single --bam_file requires --sample_id and --output_file.')
+            sys.exit(1)
         qc = QC(options)
         json_result = qc.run()
         qc.write_json_result(json_result, options.output_file)
@@ -165,5 +220,8 @@ class OptionsParser:
         elif options.subparser_name == 'converge':
             self.converge(options)
 
+        elif options.subparser_name == 'annotate':
+            self.annotate(options)
+
         elif options.subparser_name == 'qc':
             self.qc(options)
@@ -2,70 +2,127 @@
 
 import os
 import json
+import tempfile
 import subprocess
+import numpy as np
+import pandas as pd
+from jasentool.bamstats import BamStats
+from jasentool.cache import Cache
+from jasentool.convert import Convert
+from jasentool.regions import RegionCoverage
+from jasentool.scheduler import TaskGraph
+from jasentool.timing import StageTimer
 
 class QC:
     """Class for retrieving qc results"""
     def __init__(self, args):
         self.results = {}
-        self.bam = args.bam
-        self.bed = args.bed
+        self.bam = args.bam_file
+        self.bed = args.bed_file
         self.sample_id = args.sample_id
         self.cpus = args.cpus
-        self.baits = args.baits
+        self.baits = args.baits_file
         self.reference = args.reference
-        self.paired = self.is_paired()
+        self.cache = Cache(args.cache_dir)
+        self.use_pysam = args.engine == "pysam" or (args.engine == "auto" and BamStats.available())
+        self.bam_stats_engine = None
+        self.regions = RegionCoverage(args.regions_file, args.cache_dir) if args.regions_file else None
+        self.region_depth = {}
+        self.timer = StageTimer()
+        self.record_timings = args.timings
 
     def write_json_result(self, json_result, output_filepath):
         """Write out json file"""
         with open(output_filepath, 'w', encoding="utf-8") as json_file:
             json_file.write(json_result)
 
+    @staticmethod
+    def basecov_histogram(cov_fh, chunk_size=2000000, regions=None, position_chunks=None):
+        """Build depth histogram from sambamba per-base coverage read in large chunks,
+        keeping (positions, depths) within regions in position_chunks if regions are given"""
+        head = cov_fh.readline().strip().lstrip("#").split("\t")
+        cov_field = head.index("COV")
+        hist = np.zeros(1, dtype=np.int64)
+        usecols = [0, 1, cov_field] if regions else [cov_field]
+        chunks = pd.read_csv(cov_fh, sep="\t", header=None, usecols=usecols,
+                             dtype={0: str, 1: np.int64, cov_field: np.int64},
+                             chunksize=chunk_size)
+        for chunk in chunks:
+            counts = np.bincount(chunk[cov_field].to_numpy())
+            if len(counts) > len(hist):
+                hist = np.pad(hist, (0, len(counts) - len(hist)))
+            hist[:len(counts)] += counts
+            if regions:
+                for chrom, contig_chunk in chunk.groupby(0, sort=False):
+                    positions = contig_chunk[1].to_numpy()
+                    keep = regions.in_regions(chrom, positions)
+                    position_chunks.setdefault(chrom, []).append(
+                        (positions[keep], contig_chunk[cov_field].to_numpy()[keep]))
+        return hist
+
+    @staticmethod
+    def histogram_stats(hist, thresholds):
+        """Derive threshold percentages, mean and IQR/median from a depth histogram"""
+        tot_bases = int(hist.sum())
+        if not tot_bases:
+            return {min_val: 0.0 for min_val in thresholds}, 0.0, "9999"
+        above_cnt = np.cumsum(hist[::-1])[::-1]
+        above_pct = {min_val: 100 * (int(above_cnt[min_val]) / tot_bases) if min_val < len(hist) else 0.0
+                     for min_val in thresholds}
+        mean_cov = float(np.dot(np.arange(len(hist)), hist) / tot_bases)
+
+        # Calculate the inter-quartile range / median (IQR/median)
+        cumulative = np.cumsum(hist)
+        quartile1, median, quartile3 = (int(level) for level in np.searchsorted(
+            cumulative, [tot_bases / 4, tot_bases / 2, 3 * tot_bases / 4]))
+        iqr_median = (quartile3 - quartile1) / median if median else "9999"
+        return above_pct, mean_cov, iqr_median
+
     def parse_basecov_bed(self, basecov_fpath, thresholds):
         """Parse base coverage bed file"""
         with open(basecov_fpath, "r", encoding="utf-8") as cov_fh:
-            head_str = cov_fh.readline().strip().lstrip("#")
-            head = head_str.split("\t")
-            cov_field = head.index("COV")
-
-            tot_bases = 0
-            above_cnt = {min_val: 0 for min_val in thresholds}
-
-            tot, cnt = 0, 0
-            levels = {}
-            for line in cov_fh:
-                line = line.strip().split("\t")
-                tot += int(line[2])
-                cnt += 1
-                tot_bases += 1
-                for min_val in thresholds:
-                    if int(line[cov_field]) >= min_val:
-                        above_cnt[min_val] += 1
-
-            above_pct = {min_val: 100 * (above_cnt[min_val] / tot_bases) for min_val in thresholds}
-
-            mean_cov = tot / cnt
-
-            # Calculate the inter-quartile range / median (IQR/median)
-            q1_num = cnt / 4
-            q3_num = 3 * cnt / 4
-            median_num = cnt / 2
-            sum_val = 0
-            quartile1, quartile3, median = None, None, None
-            iqr_median = "9999"
-            for level in sorted(levels):
-                sum_val += levels[level]
-                if sum_val >= q1_num and not quartile1:
-                    quartile1 = level
-                if sum_val >= median_num and not median:
-                    median = level
-                if sum_val >= q3_num and not quartile3:
-                    quartile3 = level
-
-            if quartile1 and quartile3 and median:
-                iqr_median = (quartile3 - quartile1) / median
-
-            return above_pct, mean_cov, iqr_median
+            hist = self.basecov_histogram(cov_fh)
+        return self.histogram_stats(hist, thresholds)
+
+    def depth_histogram(self, threads):
+        """Stream sambamba per-base depth through a pipe straight into the depth histogram,
+        keeping depth within the QC regions if requested"""
+        cmd = ["sambamba", "depth", "base", "-c", "0", "-t", str(threads)]
+        if self.bed:
+            cmd += ["-L", self.bed]
+        cmd.append(self.bam)
+        print(f"RUNNING: {' '.join(cmd)}")
+        print()
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True,
+                              bufsize=1024 * 1024) as process:
+            try:
+                position_chunks = {}
+                hist = self.basecov_histogram(process.stdout, regions=self.regions,
+                                              position_chunks=position_chunks)
+                if self.regions:
+                    self.region_depth = self.regions.depth_from_positions(position_chunks)
+                self.timer.wait(process)
+            except Exception as error_code:
+                # Closing the pipe stops sambamba if it is still writing, then
+                # report sambamba's own failure rather than the resulting parse error
+                process.stdout.close()
+                if self.timer.wait(process) > 0:
+                    raise subprocess.CalledProcessError(process.returncode, cmd) from error_code
+                raise
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+        return hist
+
+    @staticmethod
+    def get_interval_list(cache, bed_file, dict_file):
+        """Get interval list for bed file from cache, generating it natively if missing"""
+        key = cache.content_key(bed_file, dict_file)
+        interval_list = cache.get_path("interval_lists", f"{key}.interval_list")
+        if not os.path.isfile(interval_list):
+            print(f"Generating interval list for {bed_file}...")
+            with cache.atomic_write(interval_list) as fout:
+                Convert.bed2interval_list(bed_file, dict_file, fout)
+        return interval_list
 
     def is_paired(self):
         """Check if reads are paired"""
@@ -78,67 +135,128 @@ class QC:
         """Execute subproces"""
         print(f"RUNNING: {' '.join(cmd)}")
         print()
-        subprocess.run(cmd, check=True)
+        process = subprocess.Popen(cmd)
+        if self.timer.wait(process):
+            raise subprocess.CalledProcessError(process.returncode, cmd)
 
-    def run(self):
-        """Run QC info extraction"""
-        if self.baits and self.reference:
-            print("Calculating HS-metrics...")
-            dict_file = self.reference
-            if not dict_file.endswith(".dict"):
-                dict_file += ".dict"
-            if not os.path.isfile(f"{self.bed}.interval_list"):
-                self.system_p(f"picard BedToIntervalList -I {self.bed} -O {self.bed}.interval_list -SD {dict_file}")
-            if not os.path.isfile(f"{self.baits}.interval_list"):
-                self.system_p(f"picard BedToIntervalList -I {self.baits} -O {self.baits}.interval_list -SD {dict_file}")
-            self.system_p(f"picard CollectHsMetrics -I {self.bam} -O {self.bam}.hsmetrics -R {self.reference} -BAIT_INTERVALS {self.baits}.interval_list -TARGET_INTERVALS {self.bed}.interval_list")
-
-            with open(f"{self.bam}.hsmetrics", "r", encoding="utf-8") as fin:
-                for line in fin:
-                    if line.startswith("## METRICS CLASS"):
-                        next(fin)
-                        vals = next(fin).split("\t")
-                        self.results['pct_on_target'] = vals[18]
-                        self.results['fold_enrichment'] = vals[26]
-                        self.results['median_coverage'] = vals[23]
-                        self.results['fold_80'] = vals[33]
+    @staticmethod
+    def read_picard_metrics(metrics_fpath):
+        """Get the first row of values following the picard metrics header"""
+        with open(metrics_fpath, "r", encoding="utf-8") as fin:
+            for line in fin:
+                if line.startswith("## METRICS CLASS"):
+                    next(fin)
+                    return next(fin).split("\t")
+        return []
+
+    def hsmetrics(self):
+        """Calculate hybrid selection metrics with picard"""
+        print("Calculating HS-metrics...")
+        dict_file = Convert.get_dict_file(self.reference)
+        target_intervals = self.get_interval_list(self.cache, self.bed, dict_file)
+        bait_intervals = self.get_interval_list(self.cache, self.baits, dict_file)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            hsmetrics_fpath = os.path.join(tmp_dir, "hsmetrics")
+            self.system_p("picard", "CollectHsMetrics", "-I", self.bam, "-O", hsmetrics_fpath,
+                          "-R", self.reference, "-BAIT_INTERVALS", bait_intervals,
+                          "-TARGET_INTERVALS", target_intervals)
+            vals = self.read_picard_metrics(hsmetrics_fpath)
+        return {'pct_on_target': vals[18], 'fold_enrichment': vals[26],
+                'median_coverage': vals[23], 'fold_80': vals[33]}
 
+    def flagstat(self, threads):
+        """Collect total, duplicate and mapped read counts with sambamba"""
         print("Collecting basic stats...")
-        flagstat = subprocess.check_output(f"sambamba flagstat {'-t '+str(self.cpus) if self.cpus else ''} {self.bam}", shell=True, text=True).splitlines()
-        num_reads = int(flagstat[0].split()[0])
-        dup_reads = int(flagstat[3].split()[0])
-        mapped_reads = int(flagstat[4].split()[0])
-
-        if self.paired:
-            print("Collect insert sizes...")
-            self.system_p(f"picard CollectInsertSizeMetrics -I {self.bam} -O {self.bam}.inssize -H {self.bam}.ins.pdf -STOP_AFTER 1000000")
-            with open(f"{self.bam}.inssize", "r", encoding="utf-8") as ins:
-                for line in ins:
-                    if line.startswith("## METRICS CLASS"):
-                        next(ins)
-                        vals = next(ins).split("\t")
-                        self.results['ins_size'] = vals[0]
-                        self.results['ins_size_dev'] = vals[1]
-
-            os.remove(f"{self.bam}.inssize")
-            os.remove(f"{self.bam}.ins.pdf")
-
-        out_prefix = f"{self.bam}_postalnQC"
-        thresholds = [1, 10, 30, 100, 250, 500, 1000]
+        cmd = ["sambamba", "flagstat", "-t", str(threads), self.bam]
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True) as process:
+            flagstat = process.stdout.read().splitlines()
+            if self.timer.wait(process):
+                raise subprocess.CalledProcessError(process.returncode, cmd)
+        return {'tot_reads': int(flagstat[0].split()[0]),
+                'dup_reads': int(flagstat[3].split()[0]),
+                'mapped_reads': int(flagstat[4].split()[0])}
+
+    def insert_size(self):
+        """Collect insert size metrics with picard if the reads are paired"""
+        if not self.is_paired():
+            return {}
+        print("Collect insert sizes...")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            inssize_fpath = os.path.join(tmp_dir, "inssize")
+            self.system_p("picard", "CollectInsertSizeMetrics", "-I", self.bam, "-O", inssize_fpath,
+                          "-H", os.path.join(tmp_dir, "ins.pdf"), "-STOP_AFTER", "1000000")
+            vals = self.read_picard_metrics(inssize_fpath)
+        return {'ins_size': vals[0], 'ins_size_dev': vals[1]}
 
+    def depth(self, threads):
+        """Collect depth histogram with sambamba"""
         print("Collecting depth stats...")
-        self.system_p(f"sambamba depth base -c 0 {'-t '+str(self.cpus) if self.cpus else ''} -L {self.bed} {self.bam} > {out_prefix}.basecov.bed")
-        pct_above, mean_cov, iqr_median = self.parse_basecov_bed(f"{out_prefix}.basecov.bed", thresholds)
-        os.remove(f"{out_prefix}.basecov.bed")
+        return self.depth_histogram(threads)
+
+    def bam_stats(self, threads):
+        """Collect read counts, insert sizes and depth histogram in one pass with pysam"""
+        print("Collecting basic, insert size and depth stats in one pass...")
+        self.bam_stats_engine = BamStats(self.bam, self.bed, threads)
+        counts = self.bam_stats_engine.collect()
+        if self.regions:
+            self.region_depth = {chrom: self.bam_stats_engine.contig_depth(chrom)
+                                 for chrom in self.regions.regions
+                                 if chrom in self.bam_stats_engine.lengths}
+        paired = counts.pop('paired')
+        if not paired:
+            counts.pop('ins_size', None)
+            counts.pop('ins_size_dev', None)
+        return counts, self.bam_stats_engine.depth_histogram()
+
+    def build_task_graph(self):
+        """Declare independent QC steps, giving multi-threaded tools the cpus left over"""
+        graph = TaskGraph(self.cpus)
+        single_threaded = []
+        if self.baits and self.reference:
+            single_threaded.append(('hsmetrics', self.hsmetrics))
+        if self.use_pysam:
+            multi_threaded = [('bam_stats', self.bam_stats)]
+        else:
+            single_threaded.append(('insert_size', self.insert_size))
+            multi_threaded = [('flagstat', self.flagstat), ('depth', self.depth)]
+        threads = max(1, (graph.cpus - len(single_threaded)) // len(multi_threaded))
+        for name, func in single_threaded:
+            graph.add(name, self.timed(name, func))
+        for name, func in multi_threaded:
+            graph.add(name, self.timed(name, func, threads), cpus=threads)
+        return graph
+
+    def timed(self, name, func, *args):
+        """Wrap func so that its call is recorded as a timed stage"""
+        def timed_func():
+            with self.timer.stage(name):
+                return func(*args)
+        return timed_func
+
+    def run(self):
+        """Run QC info extraction"""
+        task_results = self.build_task_graph().run()
+        if self.use_pysam:
+            counts, hist = task_results.pop('bam_stats')
+            self.results.update(counts)
+        else:
+            hist = task_results.pop('depth')
+        for result in task_results.values():
+            self.results.update(result)
+
+        thresholds = [1, 10, 30, 100, 250, 500, 1000]
+        with self.timer.stage("parsing"):
+            pct_above, mean_cov, iqr_median = self.histogram_stats(hist, thresholds)
+            if self.regions:
+                self.results['region_cov'] = self.regions.stats(self.region_depth, thresholds)
 
         self.results['pct_above_x'] = pct_above
-        self.results['tot_reads'] = num_reads
-        self.results['mapped_reads'] = mapped_reads
-        self.results['dup_reads'] = dup_reads
-        self.results['dup_pct'] = dup_reads / mapped_reads
+        self.results['dup_pct'] = self.results['dup_reads'] / self.results['mapped_reads']
         self.results['sample_id'] = self.sample_id
         self.results['mean_cov'] = mean_cov
         self.results['iqr_median'] = iqr_median
+        if self.record_timings:
+            self.results['timings'] = self.timer.report()
 
         json_result = json.dumps(self.results, indent=4)
         return json_result
@@ -0,0 +1,102 @@
+"""Module for running QC on many samples with a shared worker pool"""
+
+import os
+import sys
+import csv
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from jasentool.qc import QC
+from jasentool.cache import Cache
+from jasentool.convert import Convert
+
+class QCBatch:
+    """Class that runs QC for every sample in a manifest"""
+    def __init__(self, options):
+        self.options = options
+        self.output_dir = os.path.expanduser(options.output_dir)
+        self.workers = options.workers or max(1, options.cpus // 4)
+        self.sample_cpus = max(1, options.cpus // self.workers)
+
+    @staticmethod
+    def read_manifest(manifest_fpath):
+        """Read csv/tsv manifest with sample_id, bam_file and optional bed_file, baits_file"""
+        delimiter = "\t" if manifest_fpath.endswith((".tsv", ".txt")) else ","
+        with open(manifest_fpath, 'r', encoding="utf-8") as fin:
+            samples = [{key.strip(): (value.strip() or None) if value else None
+                        for key, value in row.items()}
+                       for row in csv.DictReader(fin, delimiter=delimiter)]
+        for sample in samples:
+            if not sample.get("sample_id") or not sample.get("bam_file"):
+                raise ValueError(f"Manifest {manifest_fpath} rows need a sample_id and bam_file")
+        return samples
+
+    def sample_args(self, sample):
+        """Build per-sample QC arguments, falling back to the command line beds"""
+        return argparse.Namespace(
+            sample_id=sample["sample_id"],
+            bam_file=sample["bam_file"],
+            bed_file=sample.get("bed_file") or self.options.bed_file,
+            baits_file=sample.get("baits_file") or self.options.baits_file,
+            reference=sample.get("reference") or self.options.reference,
+            regions_file=sample.get("regions_file") or self.options.regions_file,
+            cpus=self.sample_cpus,
+            engine=self.options.engine,
+            timings=self.options.timings,
+            cache_dir=self.options.cache_dir,
+            output_file=os.path.join(self.output_dir, f"{sample['sample_id']}_qc.json"),
+        )
+
+    @staticmethod
+    def run_sample(args):
+        """Run QC for one sample and write its json result"""
+        qc = QC(args)
+        qc.write_json_result(qc.run(), args.output_file)
+        return qc.results
+
+    @staticmethod
+    def prepare_interval_lists(samples_args):
+        """Generate each distinct interval list once before the workers start"""
+        panels = {(args.bed_file, args.baits_file, args.reference, args.cache_dir)
+                  for args in samples_args if args.baits_file and args.reference}
+        for bed_file, baits_file, reference, cache_dir in panels:
+            dict_file = Convert.get_dict_file(reference)
+            for bed in (bed_file, baits_file):
+                QC.get_interval_list(Cache(cache_dir), bed, dict_file)
+
+    def pool_kwargs(self):
+        """Worker pool arguments, with a fresh worker per sample for --timings so the process
+        peak rss is per sample (python >= 3.11, older versions reuse workers)"""
+        kwargs = {"max_workers": self.workers}
+        if self.options.timings and sys.version_info >= (3, 11):
+            kwargs["max_tasks_per_child"] = 1
+        return kwargs
+
+    def run(self, manifest_fpath):
+        """Run QC for all samples in manifest and write one json per sample plus a summary,
+        returning the summary path (None if every sample failed) and failed sample ids"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        samples_args = [self.sample_args(sample) for sample in self.read_manifest(manifest_fpath)]
+        self.prepare_interval_lists(samples_args)
+        print(f"Running QC for {len(samples_args)} samples with {self.workers} workers "
+              f"of {self.sample_cpus} cpus")
+        results, failed = [], []
+        with ProcessPoolExecutor(**self.pool_kwargs()) as executor:
+            futures = {executor.submit(self.run_sample, args): args.sample_id
+                       for args in samples_args}
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as error_code:
+                    print(f"Error running QC for {futures[future]}: {error_code}")
+                    failed.append(futures[future])
+
+        summary_fpath = None
+        if results:
+            summary_fpath = os.path.join(self.output_dir, "qc_summary.tsv")
+            summary = pd.json_normalize(results, sep="_").set_index("sample_id").sort_index()
+            summary.to_csv(summary_fpath, sep="\t")
+            print(f"QC summary of {len(results)} sample(s) written to {summary_fpath}")
+        if failed:
+            print(f"QC failed for {len(failed)} sample(s): {', '.join(sorted(failed))}")
+        return summary_fpath, failed
@@ -0,0 +1,139 @@
+"""Module for faidx-indexed, memory-mapped access to reference genomes"""
+
+import os
+import mmap
+
+class Contig:
+    """Sliceable view of one reference sequence, e.g. reference['NC_000962.3'][100:110]"""
+    def __init__(self, reference, name):
+        self.reference = reference
+        self.name = name
+
+    def __len__(self):
+        return self.reference.index[self.name][0]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(len(self))
+            seq = self.reference.fetch(self.name, start, max(start, end))
+            return seq if step == 1 else seq[::step]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(f"{self.name} position {key} out of range")
+        return self.reference.fetch(self.name, key, key + 1)
+
+class FastaIndexer:
+    """Incremental .fai index of fasta lines, so a fasta can be indexed while it is written"""
+    def __init__(self):
+        self.records = {}
+        self.name = None
+        self.offset = 0
+
+    def add(self, line):
+        """Index one fasta line (bytes including its line ending)"""
+        if line.startswith(b">"):
+            self.name = line[1:].split()[0].decode("utf-8")
+            self.records[self.name] = [0, self.offset + len(line), 0, 0]
+        elif self.name is not None:
+            bases = len(line.rstrip(b"\r\n"))
+            record = self.records[self.name]
+            if not record[2]:
+                record[2], record[3] = bases, len(line)
+            record[0] += bases
+        self.offset += len(line)
+
+    @property
+    def index(self):
+        """{name: (length, offset, linebases, linewidth)} of the lines added so far"""
+        return {name: tuple(record) for name, record in self.records.items()}
+
+    @staticmethod
+    def write_index(index, fai_filepath):
+        """Write index in samtools faidx format"""
+        with open(fai_filepath, 'w', encoding="utf-8") as fout:
+            for name, record in index.items():
+                fout.write("\t".join([name] + [str(field) for field in record]) + "\n")
+
+class Reference:
+    """Class that serves sequence slices of a fasta file via its .fai index and mmap"""
+    complements = bytes.maketrans(b"ACGTNacgtnRYKMSWrykmsw", b"TGCANtgcanYRMKSWyrmksw")
+
+    def __init__(self, fasta_filepath):
+        self.fasta_filepath = fasta_filepath
+        self.fai_filepath = f"{fasta_filepath}.fai"
+        self.index = self.load_index()
+        with open(fasta_filepath, 'rb') as fin:
+            self.mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) \
+                if os.path.getsize(fasta_filepath) else b""
+
+    def __contains__(self, chrom):
+        return chrom in self.index
+
+    def __getitem__(self, chrom):
+        if chrom not in self.index:
+            raise KeyError(f"{chrom} not found in {self.fasta_filepath}")
+        return Contig(self, chrom)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        """Names of the sequences in fasta order"""
+        return self.index.keys()
+
+    def close(self):
+        """Release the memory map"""
+        if isinstance(self.mmap, mmap.mmap):
+            self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def build_index(fasta_filepath):
+        """Scan fasta once and return {name: (length, offset, linebases, linewidth)}"""
+        indexer = FastaIndexer()
+        with open(fasta_filepath, 'rb') as fin:
+            for line in fin:
+                indexer.add(line)
+        return indexer.index
+
+    def load_index(self):
+        """Read .fai index, creating it next to the fasta when missing or stale"""
+        if os.path.isfile(self.fai_filepath) and \
+                os.path.getmtime(self.fai_filepath) >= os.path.getmtime(self.fasta_filepath):
+            with open(self.fai_filepath, 'r', encoding="utf-8") as fin:
+                return {fields[0]: tuple(int(field) for field in fields[1:5])
+                        for fields in (line.rstrip("\n").split("\t") for line in fin)}
+        index = self.build_index(self.fasta_filepath)
+        try:
+            FastaIndexer.write_index(index, self.fai_filepath)
+        except OSError:
+            # Read-only reference directories just use the in-memory index
+            pass
+        return index
+
+    def fetch(self, chrom, start, end, strand="+"):
+        """Fetch 0-based, end-exclusive sequence, reverse complemented for the '-' strand"""
+        length, offset, linebases, linewidth = self.index[chrom]
+        start, end = max(0, start), min(end, length)
+        if end <= start:
+            return ""
+        start_offset = offset + (start // linebases) * linewidth + start % linebases
+        end_offset = offset + ((end - 1) // linebases) * linewidth + (end - 1) % linebases + 1
+        seq = self.mmap[start_offset:end_offset].replace(b"\n", b"").replace(b"\r", b"")
+        if strand == "-":
+            seq = seq.translate(self.complements)[::-1]
+        return seq.decode("ascii")
+
+    @staticmethod
+    def reverse_complement(seq):
+        """Return reverse complement of a sequence string"""
+        return seq.encode("ascii").translate(Reference.complements)[::-1].decode("ascii")
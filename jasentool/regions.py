@@ -0,0 +1,103 @@
+"""Module for per-region coverage statistics from per-base depth arrays"""
+
+import numpy as np
+from jasentool.convert import Convert
+from jasentool.gff import GffIndex
+
+class RegionCoverage:
+    """Class that indexes bed/gff regions and summarises depth over each of them"""
+    def __init__(self, regions_file, cache_dir=None):
+        self.regions_file = regions_file
+        self.cache_dir = cache_dir
+        self.regions = self.index_regions(self.read_regions(regions_file))
+
+    @staticmethod
+    def read_gff(gff_file, cache_dir=None):
+        """(chrom, start, end, name) of top-level gene and pseudogene features, start is
+        0-based. Their rRNA/tRNA/ncRNA children would count rrs, rrl etc. twice"""
+        return [(feature.seqid, feature.start - 1, feature.end,
+                 feature.name or feature.locus_tag or ".")
+                for feature in GffIndex.load(gff_file, cache_dir=cache_dir).features]
+
+    def read_regions(self, regions_file):
+        """Read regions from a gff or bed file"""
+        if regions_file.endswith((".gff", ".gff3", ".gff.gz", ".gff3.gz")):
+            return self.read_gff(regions_file, self.cache_dir)
+        return [(chrom, start, end, name)
+                for chrom, start, end, _, name in Convert.read_bed(regions_file)]
+
+    @staticmethod
+    def index_regions(regions):
+        """Group regions per contig into start-sorted NumPy start/end arrays"""
+        index = {}
+        for chrom in dict.fromkeys(region[0] for region in regions):
+            contig_regions = sorted((start, end, name) for region_chrom, start, end, name
+                                    in regions if region_chrom == chrom)
+            index[chrom] = {
+                "starts": np.array([region[0] for region in contig_regions], dtype=np.int64),
+                "ends": np.array([region[1] for region in contig_regions], dtype=np.int64),
+                "names": [region[2] for region in contig_regions],
+            }
+            # Largest end so far lets a lookup by start also see earlier, longer regions
+            index[chrom]["max_ends"] = np.maximum.accumulate(index[chrom]["ends"])
+        return index
+
+    def in_regions(self, chrom, positions):
+        """Boolean mask of 0-based positions covered by any region on chrom"""
+        contig = self.regions.get(chrom)
+        if contig is None:
+            return np.zeros(len(positions), dtype=bool)
+        idx = np.searchsorted(contig["starts"], positions, side="right") - 1
+        return (idx >= 0) & (positions < contig["max_ends"][np.maximum(idx, 0)])
+
+    @staticmethod
+    def depth_from_positions(position_chunks):
+        """Assemble per-contig depth arrays from (positions, depths) chunks"""
+        depth = {}
+        for chrom, chunks in position_chunks.items():
+            length = max((int(positions.max()) + 1 for positions, _ in chunks if len(positions)),
+                         default=0)
+            contig_depth = np.zeros(length, dtype=np.int64)
+            for positions, depths in chunks:
+                contig_depth[positions] = depths
+            depth[chrom] = contig_depth
+        return depth
+
+    def stats(self, depth, thresholds):
+        """Mean, minimum and breadth at thresholds for every region, from per-contig depth"""
+        region_stats = []
+        for chrom, contig in self.regions.items():
+            contig_depth = depth.get(chrom)
+            starts, ends = contig["starts"], contig["ends"]
+            if contig_depth is None:
+                contig_depth = np.zeros(0, dtype=np.int64)
+            # Positions beyond the collected depth are uncovered
+            if len(contig_depth) < ends.max():
+                contig_depth = np.pad(contig_depth, (0, int(ends.max()) - len(contig_depth)))
+            lengths = np.maximum(ends - starts, 1)
+            depth_sums = np.concatenate(([0], np.cumsum(contig_depth)))
+            means = (depth_sums[ends] - depth_sums[starts]) / lengths
+            breadths = {}
+            for min_val in thresholds:
+                above_sums = np.concatenate(([0], np.cumsum(contig_depth >= min_val)))
+                breadths[min_val] = 100 * (above_sums[ends] - above_sums[starts]) / lengths
+            # reduceat over interleaved start/end boundaries gives the minimum of every
+            # [start, end), padded so that an end at the contig end is a valid index
+            non_empty = ends > starts
+            minimums = np.zeros(len(starts), dtype=np.int64)
+            if non_empty.any():
+                bounds = np.column_stack((starts[non_empty], ends[non_empty])).ravel()
+                minimums[non_empty] = np.minimum.reduceat(np.append(contig_depth, 0),
+                                                          bounds)[::2]
+            for idx, name in enumerate(contig["names"]):
+                region_stats.append({
+                    "name": name,
+                    "chrom": chrom,
+                    "start": int(starts[idx]),
+                    "end": int(ends[idx]),
+                    "mean_cov": float(means[idx]),
+                    "min_cov": int(minimums[idx]),
+                    "pct_above_x": {min_val: float(breadths[min_val][idx])
+                                    for min_val in thresholds},
+                })
+        return region_stats
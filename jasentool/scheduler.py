@@ -0,0 +1,50 @@
+"""Module for running small graphs of dependent tasks within a cpu budget"""
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class TaskGraph:
+    """Class that runs tasks concurrently once their dependencies have finished"""
+    def __init__(self, cpus):
+        self.cpus = max(1, cpus or 1)
+        self.tasks = {}
+
+    def add(self, name, func, deps=(), cpus=1):
+        """Add task that calls func with the results of its dependencies as keyword arguments"""
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError(f"Task {name} depends on unknown task {dep}")
+        self.tasks[name] = (func, tuple(deps), min(max(1, cpus), self.cpus))
+
+    def run(self):
+        """Run all tasks without exceeding the cpu budget and return their results by name"""
+        results = {}
+        pending = dict(self.tasks)
+        running = {}
+        free_cpus = self.cpus
+        error = None
+        with ThreadPoolExecutor(max_workers=max(1, len(self.tasks))) as executor:
+            while pending or running:
+                if error is None:
+                    for name, (func, deps, cpus) in list(pending.items()):
+                        if cpus > free_cpus or not all(dep in results for dep in deps):
+                            continue
+                        kwargs = {dep: results[dep] for dep in deps}
+                        running[executor.submit(func, **kwargs)] = (name, cpus)
+                        free_cpus -= cpus
+                        del pending[name]
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, cpus = running.pop(future)
+                    free_cpus += cpus
+                    try:
+                        results[name] = future.result()
+                    except Exception as error_code:
+                        # Let running tasks finish but do not start new ones
+                        error = error or error_code
+        if error is not None:
+            raise error
+        if pending:
+            raise ValueError(f"Tasks could not be scheduled: {', '.join(pending)}")
+        return {name: results[name] for name in self.tasks}
@@ -3,8 +3,12 @@
 import os
 import re
 import sys
+import gzip
+import numpy as np
 import pandas as pd
 from jasentool.utils import Utils
+from jasentool.gff import GffIndex
+from jasentool.reference import Reference
 
 class Tbprofiler:
     """Class that handles TBProfiler tb mutation catalogue"""
@@ -12,159 +16,268 @@ class Tbprofiler:
         self.tbdb_filepath = os.path.join(tbdb_dir, "tbdb.csv")
         self.chr_name = "Chromosome"
         self.aa_long2short = Utils.get_aa_dict()
+        self.tbdb_url = "https://raw.githubusercontent.com/jodyphelan/tbdb/master/tbdb.csv"
+        self.re_mutation = self.setup_re()
+
+    def setup_re(self):
+        """Setup one regular expression with a named alternative per mutation type, in the
+        order parse_mutation has always tried them"""
+        return re.compile(
+            r'^(?:'
+            r'p\.(?P<aa_ref>[A-Z][a-z][a-z])(?P<aa_pos>[0-9]+)(?P<aa_alt>[A-Z][a-z][a-z])'
+            r'|p\.(?P<stop_ref>[A-Z][a-z][a-z])(?P<stop_pos>[0-9]+)\*'
+            r'|c\.(?P<del_pos>[\-0-9]+)del'
+            r'|c\.(?P<dels_start>[\-0-9]+)_(?P<dels_end>[\-0-9]+)del'
+            r'|c\.(?P<ins_pos>[0-9]+)_[0-9]+ins(?P<ins_seq>[A-Z]+)'
+            r'|c\.(?P<promoter_pos>\-[0-9]+)(?P<promoter_ref>[A-Z])>(?P<promoter_alt>[A-Z])'
+            r'|r\.(?P<rna_pos>[0-9]+)(?P<rna_ref>[a-z]+)>(?P<rna_alt>[a-z]+)'
+            r'|(?P<frameshift>frameshift)'
+            r'|(?P<premature_stop>premature_stop)'
+            r'|any_missense_codon_(?P<codons_start>[0-9]+)_(?P<codons_end>[0-9]+)'
+            r'|any_missense_codon_(?P<codon>[0-9]+)'
+            r'|any_indel_nucleotide_(?P<indels_start>[0-9]+)_(?P<indels_end>[0-9]+)'
+            r'|(?P<large_deletion>large_deletion)'
+            r')')
 
     def fasta2dict(self, filepath):
-        """Convert fasta to dictionary"""
-        fa_dict = {}
-        seq_name = ""
-        with open(filepath, 'r', encoding="utf-8") as fin:
-            for line in fin:
-                line = line.rstrip()
-                if line.startswith(">"):
-                    seq_name = line[1:].split()[0]
-                    fa_dict[seq_name] = []
-                else:
-                    fa_dict[seq_name].append(line)
-        return {seq: "".join(val) for seq, val in fa_dict.items()}
+        """Get memory-mapped fasta, indexable like {name: sequence} without loading it"""
+        return Reference(filepath)
 
     def reverse_complement(self, seq):
         """Return reverse complement of a sequence"""
-        def complement(seq):
-            basecomplement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
-            letters = [basecomplement[base] for base in seq]
-            return ''.join(letters)
-        return complement(seq[::-1])
-
-    def write_gene_pos(self, infile, genes, outfile):
-        """Write out gene positions"""
-        output_txt = ""
-        with open(infile, "r", encoding="utf-8") as fin:
+        return Reference.reverse_complement(seq)
+
+    @staticmethod
+    def digit_columns(values, width):
+        """ASCII digit columns (n x width uint8) of non-negative values that have width digits"""
+        powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+        return (values[:, None] // powers % 10 + 48).astype(np.uint8)
+
+    @classmethod
+    def format_rows(cls, prefix, chr_pos, middle, gene_pos):
+        """Bytes of prefix, chr_pos, middle, gene_pos and a newline per row, built column-wise
+        as fixed width byte matrices over runs of rows with equal digit counts"""
+        bounds = 10 ** np.arange(1, 19, dtype=np.int64)
+        chr_widths = np.searchsorted(bounds, chr_pos, side="right") + 1
+        gene_abs = np.abs(gene_pos)
+        gene_widths = np.searchsorted(bounds, gene_abs, side="right") + 1
+        negative = gene_pos < 0
+        key = (chr_widths * 32 + gene_widths) * 2 + negative
+        starts = np.flatnonzero(np.diff(key, prepend=-1))
+        ends = np.append(starts[1:], len(key))
+        prefix, middle = np.frombuffer(prefix, np.uint8), np.frombuffer(middle, np.uint8)
+        blocks = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            columns = [np.broadcast_to(prefix, (end - start, len(prefix))),
+                       cls.digit_columns(chr_pos[start:end], chr_widths[start]),
+                       np.broadcast_to(middle, (end - start, len(middle)))]
+            if negative[start]:
+                columns.append(np.full((end - start, 1), ord("-"), dtype=np.uint8))
+            columns.append(cls.digit_columns(gene_abs[start:end], gene_widths[start]))
+            columns.append(np.full((end - start, 1), ord("\n"), dtype=np.uint8))
+            blocks.append(np.hstack(columns).tobytes())
+        return b"".join(blocks)
+
+    def write_gene_pos(self, infile, genes, outfile, chunk_size=1000000, compress=None):
+        """Write out chromosome to gene position table of genes, formatted column-wise in
+        chunks and gzipped if outfile ends with .gz (or compress is True)"""
+        genes = set(genes)
+        compress = outfile.endswith(".gz") if compress is None else compress
+        open_out = gzip.open if compress else open
+        with open(infile, "r", encoding="utf-8") as fin, open_out(outfile, "wb") as fout:
             for line in fin:
                 row = line.strip().split()
                 rv, gene, chr_start, chr_end, gene_start, gene_end = [row[0], row[1]]+[int(row[i]) for i in range(2,6)]
-                if rv in genes:
-                    x = 0
-                    for i, chr_pos in enumerate(range(chr_start, chr_end+1)):
-                        x = 1 if gene_start< gene_end else -1
-                        if gene_start+(x*i) == 0:
-                            x = 1 if gene_start< gene_end else -1
-                        output_txt += f"{self.chr_name}\t{chr_pos}\t{rv}\t{gene_start+(x*i)+x}\n"
-        with open(outfile, "w", encoding="utf-8") as fout:
-            fout.write(output_txt)
+                if rv not in genes:
+                    continue
+                step = 1 if gene_start < gene_end else -1
+                prefix = f"{self.chr_name}\t".encode("utf-8")
+                middle = f"\t{rv}\t".encode("utf-8")
+                for chunk_start in range(chr_start, chr_end + 1, chunk_size):
+                    chr_pos = np.arange(chunk_start, min(chunk_start + chunk_size, chr_end + 1))
+                    gene_pos = gene_start + step * (chr_pos - chr_start + 1)
+                    fout.write(self.format_rows(prefix, chr_pos, middle, gene_pos))
+
+    def get_gene_info(self, gff, genes=None):
+        """Get chromosome, 1-based feature start/end and strand of genes from a GffIndex or GFF file"""
+        if not isinstance(gff, GffIndex):
+            gff = GffIndex.load(gff)
+        gene_info = {}
+        for gene in (gff.lookup if genes is None else genes):
+            feature = gff.get(gene)
+            if feature is None:
+                continue
+            gene_info[gene] = {"chrom": feature.seqid, "start": feature.start, "end": feature.end,
+                               "strand": feature.strand}
+        return gene_info
 
     def parse_mutation(self, mut, gene, fasta_dict, gene_info):
         """Parse mutation and determine type"""
-        # AA change
-        re_obj = re.search("p.([A-Z][a-z][a-z])([0-9]+)([A-Z][a-z][a-z])", mut)
-        if re_obj:
-            ref_aa = self.aa_long2short[re_obj.group(1)]
-            alt_aa = self.aa_long2short[re_obj.group(3)]
-            codon_num = re_obj.group(2)
-            return [f"{codon_num}{ref_aa}>{codon_num}{alt_aa}"]
-        # Stop codon
-        re_obj = re.search("p.([A-Z][a-z][a-z])([0-9]+)(\*)", mut)
-        if re_obj:
-            ref_aa = self.aa_long2short[re_obj.group(1)]
-            alt_aa = re_obj.group(3)
-            codon_num = re_obj.group(2)
-            return [f"{codon_num}{ref_aa}>{codon_num}{alt_aa}"]
-        # Deletion single base
-        re_obj = re.search("c.([\-0-9]+)del", mut)
-        if re_obj:
-            gene_start_nt = int(re_obj.group(1))
-            strand = gene_info[gene]["strand"]
-            if strand == "-":
-                chr_start_nt = gene_info[gene]["end"] + gene_info[gene]["gene_end"] - gene_start_nt + (1 if gene_info[gene]["gene_end"]<0 else 0)
-            else:
-                chr_start_nt = gene_info[gene]["start"] - gene_info[gene]["gene_start"] + gene_start_nt - (0 if gene_start_nt<0 else 1)
-            seq = fasta_dict["Chromosome"][chr_start_nt-2:chr_start_nt]
-            return [f"{chr_start_nt-1}{seq}>{seq[0]}"]
-        # Deletion multi base
-        re_obj = re.search("c.([\-0-9]+)_([\-0-9]+)del", mut)
-        if re_obj:
-            gene_start_nt = int(re_obj.group(1))
-            gene_end_nt = int(re_obj.group(2))
-            del_len = gene_end_nt-gene_start_nt+1
-            strand = gene_info[gene]["strand"]
-            if strand == "-":
-                chr_start_nt = gene_info[gene]["end"] + gene_info[gene]["gene_end"] - gene_start_nt - (del_len-1) + (1 if gene_info[gene]["gene_end"]<0 else 0)
-            else:
-                chr_start_nt = gene_info[gene]["start"] - gene_info[gene]["gene_start"] + gene_start_nt - (0 if gene_start_nt<0 else 1)
-            chr_end_nt = chr_start_nt+del_len-1
-            seq = fasta_dict["Chromosome"][chr_start_nt-2:chr_end_nt]
-            return [f"{chr_start_nt-1}{seq}>{seq[0]}"]
-        # Insertion
-        re_obj = re.search("c.([0-9]+)_([0-9]+)ins([A-Z]+)", mut)
-        if re_obj:
-            gene_start_nt = int(re_obj.group(1))
-            seq_ins = re_obj.group(3)
-            strand = gene_info[gene]["strand"]
-            if strand == "-":
-                chr_start_nt = gene_info[gene]["end"] + gene_info[gene]["gene_end"] - gene_start_nt + 1
-                seq_ins = self.reverse_complement(seq_ins)
-            else:
-                chr_start_nt = gene_info[gene]["start"] - gene_info[gene]["gene_start"] + gene_start_nt - 1
-            seq_start = fasta_dict["Chromosome"][chr_start_nt-1]
-            return [f"{chr_start_nt}{seq_start}>{seq_start+seq_ins}"]
-        # Promoter Mutation
-        ## c.-16G>C
-        re_obj = re.search("c.(\-[0-9]+)([A-Z])>([A-Z])",mut)
-        if re_obj:
-            nt_pos = int(re_obj.group(1))
-            ref_nt = re_obj.group(2)
-            alt_nt = re_obj.group(3)
-            strand = gene_info[gene]["strand"]
-
-            if strand == "+":
-                #chr_pos = gene_info[gene]["start"] - (gene_info[gene]["gene_start"] - nt_pos)
-                return [f"{nt_pos}{ref_nt}>{alt_nt}"]
-            #chr_pos = gene_info[gene]["end"] + (gene_info[gene]["gene_end"] - nt_pos)
-            return [f"{nt_pos}{self.reverse_complement(ref_nt)}>{self.reverse_complement(alt_nt)}"]
-        # ncRNA Mutation
-        ## r.514a>c
-        re_obj = re.search("r.([0-9]+)([a-z]+)>([a-z]+)",mut)
-        if re_obj:
-            nt_pos = re_obj.group(1)
-            ref_nt = re_obj.group(2)
-            alt_nt = re_obj.group(3)
-            return [f"{nt_pos}{ref_nt.upper()}>{alt_nt.upper()}"]
-        # frameshift
-        re_obj = re.search("frameshift",mut)
-        if re_obj:
-            return ["frameshift"]
-        # premature_stop
-        re_obj = re.search("premature_stop",mut)
-        if re_obj:
-            return ["premature_stop"]
-        # Codon range
-        ## any_missense_codon_425_452
-        re_obj = re.search("any_missense_codon_([0-9]+)_([0-9]+)",mut)
-        if re_obj:
-            start = int(re_obj.group(1))
-            end = int(re_obj.group(2))
-            return [f"any_missense_codon_{pos}" for pos in range(start,end+1)]
-        # Codon single
-        ## any_missense_codon_425
-        re_obj = re.search("any_missense_codon_([0-9]+)",mut)
-        if re_obj:
-            start = int(re_obj.group(1))
-            return [f"any_missense_codon_{start}"]
-        # Indel range
-        re_obj = re.search("any_indel_nucleotide_([0-9]+)_([0-9]+)",mut)
-        if re_obj:
-            start = int(re_obj.group(1))
-            end = int(re_obj.group(2))
-            return [f"any_indel_nucleotide_{pos}" for pos in range(start,end+1)]
-        # large_deletion
-        re_obj = re.search("large_deletion", mut)
-        if re_obj:
-            return ["large_deletion"]
-        sys.exit(f"{mut} is not a valid formatted mutation... Exiting!")
-
-    def _parse(self, download_dir):
-        utils = Utils()
-        tbdb_url = "https://raw.githubusercontent.com/jodyphelan/tbdb/master/tbdb.csv"
+        translated = self.translate_mutations(pd.Series([mut]), pd.Series([gene]),
+                                              fasta_dict, gene_info, expand_ranges=True)
+        if translated.fail.iloc[0]:
+            sys.exit(f"{mut} is not a valid formatted mutation... Exiting!")
+        return translated.translation.iloc[0]
+
+    def gene_coordinates(self, genes, gene_info):
+        """Per-row chromosome, start, end and strand arrays for genes"""
+        # Columns are fixed so mutations without coordinates translate for unknown genes
+        info = pd.DataFrame.from_dict(gene_info, orient='index').reindex(
+            columns=['chrom', 'start', 'end', 'strand'])
+        info['chrom'] = info['chrom'].fillna(self.chr_name)
+        info = info.reindex(genes.values)
+        info.index = genes.index
+        return info
+
+    @staticmethod
+    def chrom_positions(coords, gene_pos):
+        """1-based chromosome positions of HGVS c. positions, where c.1 is the first base of
+        the feature (its start, or end on the reverse strand), c.-1 the base before it and
+        there is no c.0"""
+        gene_pos = np.asarray(gene_pos, dtype=int)
+        start, end = coords.start.to_numpy(int), coords.end.to_numpy(int)
+        return np.where((coords.strand == '-').to_numpy(),
+                        end - gene_pos + (gene_pos > 0), start + gene_pos - (gene_pos > 0))
+
+    def fetch(self, fasta_dict, chroms, starts, ends):
+        """Slice 0-based sequences per row, one slice per mutation"""
+        return [fasta_dict[chrom][start:end] for chrom, start, end in zip(chroms, starts, ends)]
+
+    def translate_mutations(self, mutations, genes, fasta_dict, gene_info, expand_ranges=False):
+        """Translate a column of tbdb HGVS mutations at once, returning translation lists
+        and collecting failures instead of exiting. Indels, which translate to vcf style
+        genomic variants, also get their chrom. Codon and nucleotide ranges stay single
+        rules unless expand_ranges is set"""
+        mutations = mutations.astype(str)
+        result = pd.DataFrame({'translation': None, 'chrom': None, 'fail': True,
+                               'fail_reason': 'not a valid formatted mutation'},
+                              index=mutations.index,
+                              columns=['translation', 'chrom', 'fail', 'fail_reason'])
+        result['translation'] = result['translation'].astype(object)
+        matched = mutations.str.extract(self.re_mutation)
+        info = self.gene_coordinates(genes, gene_info)
+        translations = {}
+        genomic_chroms = {}
+
+        def found(group):
+            return matched.index[matched[group].notna()]
+
+        def set_missing_genes(idx):
+            missing = idx[info.loc[idx, 'start'].isna()]
+            result.loc[missing, 'fail_reason'] = 'gene not found'
+            return idx.difference(missing)
+
+        # AA change and stop codon
+        for prefix, alt in (('aa', None), ('stop', '*')):
+            idx = found(f'{prefix}_pos')
+            ref_aa = matched.loc[idx, f'{prefix}_ref'].map(self.aa_long2short)
+            alt_aa = matched.loc[idx, 'aa_alt'].map(self.aa_long2short) if alt is None \
+                else pd.Series(alt, index=idx)
+            known = ref_aa.notna() & alt_aa.notna()
+            result.loc[idx[~known], 'fail_reason'] = 'unknown amino acid'
+            codon_num = matched.loc[idx[known], f'{prefix}_pos']
+            translations.update(zip(idx[known], (
+                codon_num + ref_aa[known] + '>' + codon_num + alt_aa[known]).map(lambda x: [x])))
+
+        # Deletions, single and multi base, as vcf style pos, ref and alt
+        for pos_group, end_group in (('del_pos', None), ('dels_start', 'dels_end')):
+            idx = set_missing_genes(found(pos_group))
+            coords = info.loc[idx]
+            first_nt = self.chrom_positions(coords, matched.loc[idx, pos_group].astype(int))
+            last_nt = first_nt if end_group is None else \
+                self.chrom_positions(coords, matched.loc[idx, end_group].astype(int))
+            chr_start_nt, chr_end_nt = np.minimum(first_nt, last_nt), np.maximum(first_nt, last_nt)
+            seqs = self.fetch(fasta_dict, coords.chrom, chr_start_nt - 2, chr_end_nt)
+            translations.update(zip(idx, ([f"{pos - 1}{seq}>{seq[:1]}"]
+                                          for pos, seq in zip(chr_start_nt, seqs))))
+            genomic_chroms.update(zip(idx, coords.chrom))
+
+        # Insertion, anchored on the base 5' of it on the forward strand
+        idx = set_missing_genes(found('ins_pos'))
+        coords = info.loc[idx]
+        reverse = (coords.strand == '-').to_numpy()
+        ins_pos = matched.loc[idx, 'ins_pos'].astype(int).to_numpy()
+        chr_start_nt = self.chrom_positions(coords, np.where(reverse, ins_pos + 1, ins_pos))
+        seq_ins = [Reference.reverse_complement(seq) if rev else seq
+                   for seq, rev in zip(matched.loc[idx, 'ins_seq'], reverse)]
+        seq_starts = self.fetch(fasta_dict, coords.chrom, chr_start_nt - 1, chr_start_nt)
+        translations.update(zip(idx, ([f"{pos}{seq_start}>{seq_start + seq}"] for pos, seq_start, seq
+                                      in zip(chr_start_nt, seq_starts, seq_ins))))
+        genomic_chroms.update(zip(idx, coords.chrom))
+
+        # Promoter mutation, c.-16G>C
+        idx = set_missing_genes(found('promoter_pos'))
+        promoters = matched.loc[idx, ['promoter_pos', 'promoter_ref', 'promoter_alt']]
+        for row_idx, reverse, pos, ref_nt, alt_nt in zip(idx, info.loc[idx, 'strand'] == '-',
+                                                         *promoters.T.values):
+            if reverse:
+                ref_nt, alt_nt = self.reverse_complement(ref_nt), self.reverse_complement(alt_nt)
+            translations[row_idx] = [f"{pos}{ref_nt}>{alt_nt}"]
+
+        # ncRNA mutation, r.514a>c
+        idx = found('rna_pos')
+        translations.update(zip(idx, (matched.loc[idx, 'rna_pos'] + matched.loc[idx, 'rna_ref'].str.upper()
+                                      + '>' + matched.loc[idx, 'rna_alt'].str.upper()).map(lambda x: [x])))
+
+        # Whole gene events
+        for group in ('frameshift', 'premature_stop', 'large_deletion'):
+            translations.update((row_idx, [group]) for row_idx in found(group))
+
+        # Codon and nucleotide ranges
+        for start_group, end_group, prefix in (('codons_start', 'codons_end', 'any_missense_codon'),
+                                               ('codon', 'codon', 'any_missense_codon'),
+                                               ('indels_start', 'indels_end', 'any_indel_nucleotide')):
+            idx = found(start_group)
+            for row_idx, start, end in zip(idx, matched.loc[idx, start_group].astype(int),
+                                           matched.loc[idx, end_group].astype(int)):
+                if expand_ranges:
+                    translations[row_idx] = [f"{prefix}_{pos}" for pos in range(start, end + 1)]
+                else:
+                    # Kept as one interval rule, see Catalogue.lookup_position
+                    translations[row_idx] = [f"{prefix}_{start}" if start == end
+                                             else f"{prefix}_{start}_{end}"]
+
+        translated = pd.Index(list(translations))
+        result.loc[translated, 'translation'] = pd.Series(translations)
+        result.loc[translated, 'fail'] = False
+        result.loc[translated, 'fail_reason'] = None
+        if genomic_chroms:
+            result.loc[list(genomic_chroms), 'chrom'] = pd.Series(genomic_chroms)
+        return result
+
+    def download(self, download_dir):
+        """Download TBProfiler's tbdb.csv"""
         tbdb_filepath = os.path.join(download_dir, "tbdb.csv")
-        utils.download_and_save_file(tbdb_url, tbdb_filepath)
+        return Utils.download_and_save_file(self.tbdb_url, tbdb_filepath)
+
+    def translate_tbdb(self, tbdb_df, fasta_filepath, gff_filepath):
+        """Add TBProfiler's internal mutation format of every tbdb row as a Translation column,
+        and the chromosome of translations that are genomic variants as a Chromosome column"""
+        reference = self.fasta2dict(fasta_filepath)
+        gene_info = self.get_gene_info(gff_filepath, tbdb_df.Gene.dropna().unique())
+        if len(reference) == 1:
+            # tbdb refers to the chromosome by name, the downloaded fasta by accession
+            for info in gene_info.values():
+                info["chrom"] = next(iter(reference))
+        translated = self.translate_mutations(tbdb_df.Mutation, tbdb_df.Gene, reference, gene_info)
+        tbdb_df['Translation'] = translated.translation.map(
+            lambda translation: ','.join(translation) if translation else None)
+        tbdb_df['Chromosome'] = translated.chrom
+        failed = translated[translated.fail]
+        if not failed.empty:
+            print(f"Could not translate {len(failed)} tbdb mutations: " + ', '.join(
+                f"{gene} {mut} ({reason})" for gene, mut, reason in zip(
+                    tbdb_df.Gene[failed.index][:10], tbdb_df.Mutation[failed.index][:10],
+                    failed.fail_reason[:10])))
+        return tbdb_df
+
+    def _parse(self, download_dir, tbdb_filepath=None, fasta_filepath=None, gff_filepath=None):
+        """Parse tbdb.csv, downloading it unless tbdb_filepath is provided, and translate its
+        mutations if the reference fasta and gff are provided"""
+        if tbdb_filepath is None:
+            tbdb_filepath = self.download(download_dir)
         tbdb_df = pd.read_csv(tbdb_filepath, header=0)
+        if fasta_filepath and gff_filepath and \
+                os.path.isfile(fasta_filepath) and os.path.isfile(gff_filepath):
+            tbdb_df = self.translate_tbdb(tbdb_df, fasta_filepath, gff_filepath)
         return tbdb_df
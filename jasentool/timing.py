@@ -0,0 +1,64 @@
+"""Module for timing stages and measuring their resource usage"""
+
+import os
+import sys
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+class StageTimer:
+    """Class that records wall time and cpu time per stage, including child processes, and
+    the cpu time and peak rss of the whole process.
+
+    Stages run in parallel threads, so a stage's own cpu time is that of its calling thread
+    and misses threads started by libraries (e.g. htslib decompression threads), which only
+    show up in the process cpu time. ru_maxrss cannot be reset, so the peak rss is only
+    reported for the whole process."""
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    RSS_TO_MB = 1 / (1024 * 1024) if sys.platform == "darwin" else 1 / 1024
+
+    def __init__(self):
+        self.start_cpu = time.process_time()
+        self.timings = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as stage name (stages may run in parallel threads)"""
+        self._local.child_usage = {"cpu_time_s": 0.0, "peak_rss_mb": 0.0}
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            child_usage = self._local.child_usage
+            with self._lock:
+                self.timings[name] = {
+                    "wall_time_s": round(time.perf_counter() - start_wall, 3),
+                    "thread_cpu_time_s": round(time.thread_time() - start_cpu, 3),
+                    "child_cpu_time_s": round(child_usage["cpu_time_s"], 3),
+                    "child_peak_rss_mb": round(child_usage["peak_rss_mb"], 1),
+                }
+
+    def process_usage(self):
+        """Cpu time of all threads since the timer was created and peak rss of the process"""
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * self.RSS_TO_MB
+        return {"cpu_time_s": round(time.process_time() - self.start_cpu, 3),
+                "peak_rss_mb": round(peak_rss, 1)}
+
+    def report(self):
+        """Stage timings plus the usage of the whole process under 'process'"""
+        return dict(self.timings, process=self.process_usage())
+
+    def wait(self, process):
+        """Reap a subprocess.Popen and add its own cpu time and peak rss to the current stage"""
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        child_usage = getattr(self._local, "child_usage", None)
+        if child_usage is not None:
+            child_usage["cpu_time_s"] += usage.ru_utime + usage.ru_stime
+            child_usage["peak_rss_mb"] = max(child_usage["peak_rss_mb"],
+                                             usage.ru_maxrss * self.RSS_TO_MB)
+        return process.returncode
@@ -0,0 +1,115 @@
+"""Module for checksum-aware transfer of files to local or remote directories"""
+
+import os
+import shlex
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from jasentool.utils import Utils
+
+class Transfer:
+    """Class that copies files only when the destination content differs"""
+    def __init__(self, dest_dir, remote_hostname=None, remote=False, threads=4):
+        self.dest_dir = dest_dir
+        self.remote_hostname = remote_hostname
+        self.remote = remote
+        self.threads = threads
+
+    def _ssh(self, command, capture=False):
+        """Run command on the remote host"""
+        process = subprocess.run(
+            ["ssh", self.remote_hostname, command],
+            check=True,
+            stdout=subprocess.PIPE if capture else None,
+            universal_newlines=True
+        )
+        return process.stdout
+
+    @staticmethod
+    def _tmp_name(filename):
+        """Hidden temporary filename used while a file is being written"""
+        return f".{filename}.jasentool.tmp"
+
+    def local_state(self, filenames):
+        """Get size of files already present in local destination (hashed lazily)"""
+        states = {}
+        for filename in filenames:
+            filepath = os.path.join(self.dest_dir, filename)
+            if os.path.isfile(filepath):
+                states[filename] = (os.path.getsize(filepath), None)
+        return states
+
+    def remote_state(self, filenames):
+        """Get size and checksum of files already present in remote destination"""
+        quoted_dir = shlex.quote(self.dest_dir)
+        quoted_files = " ".join(shlex.quote(filename) for filename in filenames)
+        command = (f'mkdir -p {quoted_dir} && cd {quoted_dir} && '
+                   f'for f in {quoted_files}; do '
+                   f'[ -f "$f" ] && echo "$(stat -c %s "$f") $(sha256sum "$f")"; '
+                   f'done; true')
+        states = {}
+        for line in self._ssh(command, capture=True).splitlines():
+            size, checksum, filename = line.split(maxsplit=2)
+            states[filename] = (int(size), checksum)
+        return states
+
+    def is_unchanged(self, source, state):
+        """Compare size first and only hash files when the sizes match"""
+        if state is None or os.path.getsize(source) != state[0]:
+            return False
+        dest_checksum = state[1]
+        if dest_checksum is None:
+            dest_checksum = Utils.file_checksum(
+                os.path.join(self.dest_dir, os.path.basename(source)))
+        return Utils.file_checksum(source) == dest_checksum
+
+    def copy_local(self, source):
+        """Copy file into local destination through a temporary file and rename"""
+        filename = os.path.basename(source)
+        tmp_filepath = os.path.join(self.dest_dir, self._tmp_name(filename))
+        shutil.copyfile(source, tmp_filepath)
+        shutil.copymode(source, tmp_filepath)
+        os.replace(tmp_filepath, os.path.join(self.dest_dir, filename))
+
+    def copy_remote(self, source):
+        """Copy file to a temporary name on the remote host"""
+        tmp_filepath = os.path.join(self.dest_dir, self._tmp_name(os.path.basename(source)))
+        subprocess.run(
+            ["scp", "-q", source, f"{self.remote_hostname}:{tmp_filepath}"],
+            check=True
+        )
+
+    def rename_remote(self, sources):
+        """Move all remote temporary files into place with a single ssh call"""
+        moves = []
+        for source in sources:
+            filename = os.path.basename(source)
+            tmp_filepath = os.path.join(self.dest_dir, self._tmp_name(filename))
+            final_filepath = os.path.join(self.dest_dir, filename)
+            moves.append(f"mv -f {shlex.quote(tmp_filepath)} {shlex.quote(final_filepath)}")
+        self._ssh(" && ".join(moves))
+
+    def sync(self, files):
+        """Copy files that are missing or differ in destination, return the files copied"""
+        filenames = [os.path.basename(filepath) for filepath in files]
+        if self.remote:
+            states = self.remote_state(filenames)
+        else:
+            os.makedirs(self.dest_dir, exist_ok=True)
+            states = self.local_state(filenames)
+
+        to_copy = [source for source, filename in zip(files, filenames)
+                   if not self.is_unchanged(source, states.get(filename))]
+        skipped = len(files) - len(to_copy)
+        if skipped:
+            print(f"Skipping {skipped} unchanged file(s) in {self.dest_dir}")
+        if not to_copy:
+            return []
+
+        copy_func = self.copy_remote if self.remote else self.copy_local
+        with ThreadPoolExecutor(max_workers=max(1, self.threads)) as executor:
+            list(executor.map(copy_func, to_copy))
+        if self.remote:
+            self.rename_remote(to_copy)
+        print(f"Copied {len(to_copy)} file(s) to {self.dest_dir}")
+        return to_copy
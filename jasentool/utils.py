@@ -3,11 +3,10 @@
 import os
 import csv
 import shutil
-import pathlib
+import hashlib
 import subprocess
 from time import sleep
 from zipfile import ZipFile
-import requests
 
 class Utils:
     """Class containing utilities used throughout jasentool"""
@@ -44,25 +43,13 @@ class Utils:
         return False
 
     @staticmethod
-    def copy_batch_and_csv_files(batch_files, csv_files, remote_dir, remote_hostname, remote=False):
-        """Copy shell and csv files to desired (remote) location"""
-        if remote:
-            # Copy files to remote server using ssh/scp
-            process = subprocess.run(
-                f'ssh {remote_hostname} mkdir -p {remote_dir}',
-                shell=True
-            )
-            process = subprocess.run(
-                f'scp {" ".join(batch_files)} {" ".join(csv_files)} {remote_hostname}:{remote_dir}',
-                shell=True,
-                stdout=subprocess.PIPE,
-                universal_newlines=True
-            )
-        else:
-            # Copy files to a local directory
-            pathlib.Path(remote_dir).mkdir(parents=True, exist_ok=True)
-            for fin in batch_files + csv_files:
-                shutil.copy(fin, remote_dir)
+    def file_checksum(filepath, algorithm="sha256", chunk_size=1024 * 1024):
+        """Get hex digest of file content"""
+        digest = hashlib.new(algorithm)
+        with open(filepath, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
 
     @staticmethod
     def start_remote_pipelines(batch_files, remote_hostname, remote_dir):
@@ -77,23 +64,12 @@ class Utils:
                 )
 
     @staticmethod
-    def download_and_save_file(url, output_filepath):
-        """Download the file and save it to the user-specified path"""
-        try:
-            # Make a request to the URL
-            response = requests.get(url, stream=True)
-            response.raise_for_status()  # Raise an error for bad responses
-
-            # Open the output file in binary write mode
-            with open(output_filepath, 'wb') as output_file:
-                # Iterate over the content in chunks and write to the file
-                for chunk in response.iter_content(chunk_size=8192):
-                    output_file.write(chunk)
-
-            print(f"File downloaded and saved to: {output_filepath}")
-
-        except requests.exceptions.RequestException as error_code:
-            print(f"Error downloading the file: {error_code}")
+    def download_and_save_file(url, output_filepath, timeout=60, retries=3, cache_dir=None):
+        """Download the file and save it to the user-specified path, revalidating a cached
+        copy with a conditional request so unchanged files are not transferred again"""
+        # Imported here as the download cache itself depends on Utils
+        from jasentool.download import DownloadCache
+        return DownloadCache(cache_dir).download(url, output_filepath, timeout, retries)
 
     @staticmethod
     def unzip(zip_file, outdir):
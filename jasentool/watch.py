@@ -0,0 +1,172 @@
+"""Module for watching bjorn output and fixing new sequencing runs as they appear"""
+
+import os
+import csv
+import json
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from jasentool.missing import Missing
+
+class Inotify:
+    """Minimal ctypes wrapper around linux inotify for watching a directory"""
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = 0x00000800
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+
+    def wait(self, timeout):
+        """Block until an event arrives or timeout, return the filenames touched"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except OSError as error_code:
+            if error_code.errno == errno.EAGAIN:
+                return set()
+            raise
+        filenames = set()
+        offset = 0
+        while offset < len(buffer):
+            _, _, _, name_len = self.EVENT_HEADER.unpack_from(buffer, offset)
+            offset += self.EVENT_HEADER.size
+            filenames.add(os.fsdecode(buffer[offset:offset + name_len].rstrip(b'\0')))
+            offset += name_len
+        return filenames
+
+    def close(self):
+        """Close inotify file descriptor"""
+        os.close(self.fd)
+
+class Watch:
+    """Class that waits for new bjorn csv/sh pairs and runs a callback once per run"""
+    def __init__(self, csv_file, sh_file, state_file, debounce=30.0, poll_interval=60.0):
+        self.csv_file = os.path.abspath(csv_file)
+        self.sh_file = os.path.abspath(sh_file)
+        self.state_file = os.path.expanduser(state_file)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.processed = self.load_state()
+
+    def load_state(self):
+        """Load run ids that have already been processed"""
+        if not os.path.isfile(self.state_file):
+            return set()
+        with open(self.state_file, 'r', encoding="utf-8") as fin:
+            return set(json.load(fin))
+
+    def save_state(self):
+        """Save processed run ids, replacing the state file atomically"""
+        state_dir = os.path.dirname(self.state_file)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        tmp_filepath = f"{self.state_file}.tmp"
+        with open(tmp_filepath, 'w', encoding="utf-8") as fout:
+            json.dump(sorted(self.processed), fout, indent=4)
+        os.replace(tmp_filepath, self.state_file)
+
+    @staticmethod
+    def get_run_id(csv_file):
+        """Get sequencing run id from the read paths of the first sample in bjorn csv"""
+        with open(csv_file, 'r', encoding="utf-8") as fin:
+            reader = csv.reader(fin)
+            next(reader, None)
+            first_row = next(reader, None)
+        if not first_row:
+            return None
+        for field in first_row:
+            if "/" in field:
+                run_id = Missing.get_seqrun_from_filepath(field)
+                if run_id:
+                    return run_id
+        return None
+
+    def signature(self):
+        """Size and modification time of both files, None if either is missing"""
+        try:
+            return tuple((stat.st_size, stat.st_mtime_ns)
+                         for stat in (os.stat(self.csv_file), os.stat(self.sh_file)))
+        except FileNotFoundError:
+            return None
+
+    def open_notifier(self):
+        """Use inotify when available and fall back to polling otherwise"""
+        watch_dirs = {os.path.dirname(self.csv_file), os.path.dirname(self.sh_file)}
+        if len(watch_dirs) != 1:
+            print("WARN: csv and sh files are in different directories, polling instead.")
+            return None
+        try:
+            return Inotify(watch_dirs.pop())
+        except (OSError, AttributeError) as error_code:
+            print(f"WARN: inotify unavailable ({error_code}), polling every {self.poll_interval}s.")
+            return None
+
+    def run(self, process_run):
+        """Watch csv/sh pair and call process_run(run_id) for every new, settled run"""
+        watched = {os.path.basename(self.csv_file), os.path.basename(self.sh_file)}
+        notifier = self.open_notifier()
+        last_signature = self.signature()
+        checked_signature = None
+        failures, retry_at = 0, 0.0
+        changed_at = time.monotonic()
+        print(f"Watching {self.csv_file} and {self.sh_file}")
+        try:
+            while True:
+                # Wake on events early while a change is settling, otherwise wait longer
+                settling = time.monotonic() - changed_at < self.debounce
+                timeout = self.debounce if settling else self.poll_interval
+                if notifier:
+                    if notifier.wait(timeout) & watched:
+                        changed_at = time.monotonic()
+                else:
+                    time.sleep(min(timeout, self.poll_interval))
+
+                current_signature = self.signature()
+                if current_signature != last_signature:
+                    last_signature = current_signature
+                    changed_at = time.monotonic()
+                    failures, retry_at = 0, 0.0
+                    continue
+                if (current_signature in (None, checked_signature) or
+                        time.monotonic() - changed_at < self.debounce or
+                        time.monotonic() < retry_at):
+                    continue
+
+                run_id = self.get_run_id(self.csv_file)
+                if not run_id or run_id in self.processed:
+                    checked_signature = current_signature
+                    continue
+                print(f"New sequencing run detected: {run_id}")
+                try:
+                    process_run(run_id)
+                except Exception as error_code:
+                    # Failed runs (e.g. a transient scp error) are retried with a backoff
+                    backoff = min(self.poll_interval * 2 ** failures, 3600.0)
+                    failures += 1
+                    retry_at = time.monotonic() + backoff
+                    print(f"Error processing run {run_id}: {error_code}, "
+                          f"retrying in {backoff:.0f}s")
+                    continue
+                checked_signature = current_signature
+                failures, retry_at = 0, 0.0
+                self.processed.add(run_id)
+                self.save_state()
+        finally:
+            if notifier:
+                notifier.close()
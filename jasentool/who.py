@@ -2,23 +2,32 @@
 
 import os
 import re
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
 from jasentool.utils import Utils
+from jasentool.cache import Cache
+from jasentool.workbook import Workbook
+from jasentool.gff import GffIndex
+from jasentool.reference import Reference
 
 class WHO:
     """Class for handling WHO tb mutation catalogue"""
-    def __init__(self):
+    def __init__(self, cache_dir=None):
+        self.cache = Cache(cache_dir)
         self.aa_dict_1 = Utils.get_aa_dict()
         self.aa_dict_2 = self.inv_dict()
         self.nucleotide_complements = self.get_nt_complements()
         self.drug_dict = self.get_drug_dict()
         self.re_c, self.re_p, self.re_d, self.re_i = self.setup_re()
-        self.re_attr = re.compile('Name=([^;]+).*locus_tag=([^;|\n]+)')
+        self.catalogue_columns = ['drug', 'gene', 'mutation', 'FINAL CONFIDENCE GRADING']
+        #self.who_url = "https://apps.who.int/iris/bitstream/handle/10665/341906/WHO-UCN-GTB-PCI-2021.7-eng.xlsx"
+        self.who_url = "https://raw.githubusercontent.com/GTB-tbsequencing/mutation-catalogue-2023/main/Final%20Result%20Files/WHO-UCN-TB-2023.6-eng.xlsx"
 
     def inv_dict(self):
-        """Invert amino acid dictionary"""
-        return {v: k for k, v in self.aa_dict_1.items()}
+        """Invert amino acid dictionary, writing WHO's stop code '!' as HGVS '*' like tbdb"""
+        aa_dict = {v: k for k, v in self.aa_dict_1.items()}
+        aa_dict.update({'*': '*', '!': '*'})
+        return aa_dict
 
     def get_nt_complements(self):
         """Get nucleotide complements"""
@@ -63,24 +72,25 @@ class WHO:
 
     def read_files(self, gff_filepath, xlsx_filepath, h37rv_filepath):
         """Read gff, excel & genome files"""
-        # Load the reference GFF file
-        columns = ['seqid', 'source', 'type', 'start', 'end',
-                   'score', 'strand', 'phase', 'attributes']
-        gff = pd.read_csv(gff_filepath, names=columns, sep='\t', header=None)
+        # Load the (cached) gene index of the reference GFF file
+        gff = GffIndex.load(gff_filepath)
         # Load the WHO catalogue
-        catalogue = pd.read_excel(xlsx_filepath, sheet_name='Catalogue_master_file', header=2)
-        # Load the reference genome to impute missing data from deletions
-        h37rv = ''
-        with open(h37rv_filepath, 'r', encoding="utf-8") as fin:
-            for line in fin:
-                h37rv += line.replace('\n', '')
+        catalogue = self.read_catalogue(xlsx_filepath)
+        # Memory-map the reference genome to impute missing data from deletions
+        reference = Reference(h37rv_filepath)
+        h37rv = reference[next(iter(reference))]
         return gff, catalogue, h37rv
 
+    def read_catalogue(self, xlsx_filepath):
+        """Stream the catalogue columns needed for convergence from the WHO master sheet"""
+        return Workbook.read_sheet(xlsx_filepath, 'Catalogue_master_file', header=2,
+                                   columns=self.catalogue_columns)
+
     def process_variant(self, variant, gff_dict):
         """Translates variants in the WHO catalogue format to HGVS"""
         c_match = self.re_c.match(variant)
         if c_match:
-            if gff_dict[c_match[1]]['type'] == 'rRNA':
+            if gff_dict[c_match[1]]['biotype'] == 'rRNA':
                 v_type = 'n'
                 ref = c_match[2].upper()
                 alt = c_match[4].upper()
@@ -103,7 +113,7 @@ class WHO:
                       if d_match[4][:pos]+d_match[4][pos+int(d_match[3]):] == d_match[5]]
             if not starts:
                 return (None, None, None, True, 'invalid indel')
-            if not gff_dict[d_match[1]]['strand']:
+            if not gff_dict[d_match[1]]['reverse']:
                 hgvs = []
                 for start in starts:
                     if int(d_match[3]) == 1:
@@ -127,7 +137,7 @@ class WHO:
             starts = [pos for pos in range(1, len(i_match[4]) + 1) if i_match[4][:pos]+i_match[5][pos:pos+int(i_match[3])]+i_match[4][pos:] == i_match[5]]
             if not starts:
                 return (None, None, None, True, 'invalid indel')
-            if not gff_dict[i_match[1]]['strand']:
+            if not gff_dict[i_match[1]]['reverse']:
                 hgvs = []
                 for start in starts:
                     start_pos = int(i_match[2])+start-1
@@ -148,36 +158,11 @@ class WHO:
 
         return (None, None, None, True, 'does not match indel or variant')
 
-    def extract_info(self, info_string):
-        """Extract gene name and locus tag from provided string"""
-        if pd.notna(info_string):
-            match = self.re_attr.search(info_string)
-            if match:
-                if len(match.groups([1, 2])) != 2:
-                    print(match.groups([1, 2]))
-                return pd.Series(match.groups([1, 2]))
-        return pd.Series([None, None])
-
     def get_gene_info(self, gff):
-        """Get gene info from the GFF file and apply the function to the 'attributes' column"""
-        gff[['locus_tag', 'name']] = gff.attributes.apply(self.extract_info)
-
-        gff_dict = {}
-        for _, row in gff.iterrows():
-            gene = {}
-            gene['seqid'] = row.seqid
-            gene['source'] = row.source
-            gene['type'] = row.type
-            gene['start'] = row.start
-            gene['end'] = row.end
-            gene['score'] = row.score
-            gene['strand'] = 0 if row.strand == '+' else 1
-            gene['attributes'] = row.attributes
-            gene['locus_tag'] = row.locus_tag
-            gene['name'] = row['name']
-            gff_dict[row['locus_tag']] = gene
-            gff_dict[row['name']] = gene
-        return gff_dict
+        """Get gene features keyed by both name and locus tag from a GffIndex or GFF file"""
+        if not isinstance(gff, GffIndex):
+            gff = GffIndex.load(gff)
+        return gff.lookup
 
     def prep_catalogue(self, catalogue):
         """Prepare the WHO catalogue dataframe"""
@@ -204,92 +189,111 @@ class WHO:
         classified = pd.DataFrame(classified, columns=column_names)
         return classified
 
+    def classify_variants(self, variants, gff_dict):
+        """Translate a Series of WHO catalogue variants to HGVS column-wise, falling back to
+        process_variant per row only for indels"""
+        variants = variants.astype(str)
+        columns = ['gene', 'hgvs', 'type', 'fail', 'fail_reason']
+        result = pd.DataFrame({'gene': None, 'hgvs': None, 'type': None, 'fail': True,
+                               'fail_reason': 'does not match indel or variant'},
+                              index=variants.index, columns=columns)
+
+        # Nucleotide substitutions, 'n' for rRNA genes and 'c' otherwise
+        c_match = variants.str.extract(self.re_c).dropna()
+        gene_types = {gene: info['biotype'] for gene, info in gff_dict.items()}
+        var_types = pd.Series(np.where(c_match[0].map(gene_types) == 'rRNA', 'n', 'c'),
+                              index=c_match.index)
+        result.loc[c_match.index, columns] = pd.DataFrame({
+            'gene': c_match[0],
+            'hgvs': var_types + '.' + c_match[2] + c_match[1].str.upper() + '>' + c_match[3].str.upper(),
+            'type': var_types,
+            'fail': False,
+            'fail_reason': None,
+        })
+
+        # Protein substitutions
+        p_match = variants.drop(c_match.index).str.extract(self.re_p).dropna()
+        ref_aa = p_match[1].str.upper().map(self.aa_dict_2)
+        alt_aa = p_match[3].str.upper().map(self.aa_dict_2)
+        known_aa = ref_aa.notna() & alt_aa.notna()
+        p_ok = p_match[known_aa]
+        result.loc[p_ok.index, columns] = pd.DataFrame({
+            'gene': p_ok[0],
+            'hgvs': 'p.' + ref_aa[known_aa] + p_ok[2] + alt_aa[known_aa],
+            'type': 'p',
+            'fail': False,
+            'fail_reason': None,
+        })
+        result.loc[p_match.index[~known_aa], 'fail_reason'] = 'unknown amino acid'
+
+        # Deletions and insertions need the per-row indel alignment
+        remaining = variants.drop(c_match.index.union(p_match.index))
+        indels = remaining[remaining.str.contains('_(?:del|ins)_', regex=True)]
+        if not indels.empty:
+            result.loc[indels.index, columns] = pd.DataFrame(
+                [self.process_variant(variant, gff_dict) for variant in indels],
+                index=indels.index, columns=['gene', 'type', 'hgvs', 'fail', 'fail_reason'])
+        return result
+
     def var2hgvs(self, classified, gff_dict):
         """Convert the variants to HGVS format"""
-        for idx, row in tqdm(classified.iterrows(), total=classified.shape[0]):
-            gene, var_type, variant, fail, fail_reason = self.process_variant(row.variant, gff_dict)
-            classified.loc[idx, 'gene'] = gene
-            classified.loc[idx, 'hgvs'] = variant
-            classified.loc[idx, 'type'] = var_type
-            classified.loc[idx, 'fail'] = fail
-            classified.loc[idx, 'fail_reason'] = fail_reason
+        converted = self.classify_variants(classified.variant, gff_dict)
+        for column in converted.columns:
+            classified[column] = converted[column]
         return classified
 
     def impute_del(self, classified, gff_dict, h37rv):
         """Impute missing data for deletions"""
-        length_mismatch = classified[classified.fail_reason == 'length mismatch'].sort_values(by='variant', key=self.lower_row)
-
-        for idx, row in tqdm(length_mismatch.iterrows(), total=length_mismatch.shape[0]):
-            d_match = self.re_d.match(row.variant)
-            if d_match:
-                if not gff_dict[d_match[1]]['strand']:
-                    # Correct for 0 based python indexing (-1 if promotor, -2 if within gene)
-                    indexing_correction = -1 if int(d_match[2]) < 0 else -2
-
-                    start = int(gff_dict[d_match[1]]['start']) + int(d_match[2]) + int(indexing_correction)
-
-                    # add the length of the alt allele to account for the bases not part of the indel
-                    end = start + int(d_match[3]) + len(d_match[5])
-                    try:
-                        complete_variant = f'{d_match[1]}_{d_match[2]}_del_{d_match[3]}_{h37rv[start:end].lower()}_{d_match[5]}'
-                    except TypeError:
-                        print(f"{start}: {type(start)}\n{end}: {type(end)}")
-                    classified.loc[idx, 'complete_variant'] = complete_variant
-                    classified.loc[idx, 'complete_variant_fail'] = False
-                else:
-                    # Correct for 0 based python indexing (-1 if promotor, 0 if within gene)
-                    indexing_correction = -1 if int(d_match[2]) < 0 else 0
-
-                    # Subtract d_match[2] instead of adding as this is the opposite strand
-                    start = int(gff_dict[d_match[1]]['end']) - int(d_match[2]) + int(indexing_correction)
-
-                    # Add the length of the alt allele to account for the bases not part of the indel
-                    end = start + int(d_match[3]) + len(d_match[5])
+        length_mismatch = classified.variant[classified.fail_reason == 'length mismatch'].astype(str)
+        d_match = length_mismatch.str.extract(self.re_d).dropna()
+        if 'complete_variant_fail' not in classified:
+            classified['complete_variant'] = None
+            classified['complete_variant_fail'] = None
+            classified['complete_variant_fail_reason'] = None
 
-                    complete_variant = f'{d_match[1]}_{d_match[2]}_del_{d_match[3]}_{h37rv[start:end].lower()}_{d_match[5]}'
-                    classified.loc[idx, 'complete_variant'] = complete_variant
-                    classified.loc[idx, 'complete_variant_fail'] = False
-                continue
+        if not d_match.empty:
+            gene_pos = d_match[1].astype(int)
+            del_len = d_match[2].astype(int)
+            reverse = d_match[0].map({gene: info['reverse'] for gene, info in gff_dict.items()}).astype(bool)
+            gene_start = d_match[0].map({gene: info['start'] for gene, info in gff_dict.items()})
+            gene_end = d_match[0].map({gene: info['end'] for gene, info in gff_dict.items()})
+            # Correct for 0 based python indexing: forward strand -1 if promotor, -2 if within
+            # gene; reverse strand -1 if promotor, 0 if within gene and subtract the position
+            promoter = gene_pos < 0
+            start = np.where(reverse,
+                             gene_end.astype(int) - gene_pos + np.where(promoter, -1, 0),
+                             gene_start.astype(int) + gene_pos + np.where(promoter, -1, -2))
+            # Add the length of the alt allele to account for the bases not part of the indel
+            end = start + del_len + d_match[4].str.len()
+            ref_seqs = [h37rv[seq_start:seq_end].lower() for seq_start, seq_end in zip(start, end)]
+            classified.loc[d_match.index, 'complete_variant'] = (
+                d_match[0] + '_' + d_match[1] + '_del_' + d_match[2] + '_' +
+                pd.Series(ref_seqs, index=d_match.index) + '_' + d_match[4])
+            classified.loc[d_match.index, 'complete_variant_fail'] = False
 
-            i_match = self.re_i.match(row.variant)
-            if i_match:
-                classified.loc[idx, 'complete_variant_fail'] = True
-                classified.loc[idx, 'complete_variant_fail_reason'] = 'Not assuming for insertions'
-                if not gff_dict[i_match[1]]['strand']:
-                    pass
-                else:
-                    pass
-                continue
+        insertions = length_mismatch.index[length_mismatch.str.match(self.re_i)]
+        classified.loc[insertions, 'complete_variant_fail'] = True
+        classified.loc[insertions, 'complete_variant_fail_reason'] = 'Not assuming for insertions'
         return classified
 
     def imp2hgvs(self, classified, gff_dict):
         """Convert imputed deletions to HGVS format"""
-        for idx, row in tqdm(classified[classified.complete_variant_fail == False].iterrows(),
-                             total=classified[classified.complete_variant_fail == False].shape[0]):
-            if row.complete_variant_fail:
-                continue
-            gene, var_type, variant, fail, fail_reason = self.process_variant(row.complete_variant, gff_dict)
-            classified.loc[idx, 'gene'] = gene
-            classified.loc[idx, 'hgvs'] = variant
-            classified.loc[idx, 'type'] = var_type
-            classified.loc[idx, 'fail'] = fail
-            classified.loc[idx, 'fail_reason'] = fail_reason
+        imputed = classified.complete_variant_fail == False
+        converted = self.classify_variants(classified.loc[imputed, 'complete_variant'], gff_dict)
+        classified.loc[imputed, converted.columns] = converted
         return classified
 
     def write_out_csv(self, classified, csv_outpath):
         """Write results to csv file"""
         classified.to_csv(csv_outpath, index=False)
 
-    def _parse(self, fasta_filepath, gff_filepath, download_dir):
-        """Parse WHO excel file"""
-        utils = Utils()
-        #who_url = "https://apps.who.int/iris/bitstream/handle/10665/341906/WHO-UCN-GTB-PCI-2021.7-eng.xlsx"
-        who_url = "https://raw.githubusercontent.com/GTB-tbsequencing/mutation-catalogue-2023/main/Final%20Result%20Files/WHO-UCN-TB-2023.6-eng.xlsx"
+    def download(self, download_dir):
+        """Download the WHO mutation catalogue excel file"""
         who_filepath = os.path.join(download_dir, "who.xlsx")
-        utils.download_and_save_file(who_url, who_filepath)
-        _, catalogue, _ = self.read_files(gff_filepath, who_filepath, fasta_filepath)
-        #gff, catalogue, h37rv = self.read_files(gff_filepath, who_filepath, fasta_filepath)
-        #gff_dict = self.get_gene_info(gff)
+        return Utils.download_and_save_file(self.who_url, who_filepath)
+
+    def normalise_catalogue(self, catalogue):
+        """Normalise WHO catalogue to the converged catalogue columns"""
         catalogue.columns = catalogue.columns.str.title()
         catalogue.rename(columns={'Final Confidence Grading': 'WHO Confidence'}, inplace=True)
         catalogue['Confers'] = 'resistance'
@@ -297,8 +301,19 @@ class WHO:
         catalogue['Literature'] = 'https://www.who.int/publications/i/item/9789240082410'
         catalogue['WHO Confidence'] = catalogue['WHO Confidence'].apply(lambda x: ' '.join(x.split(' ')[1:]))
         catalogue['Drug'] = catalogue['Drug'].apply(lambda x: x.lower())
-        catalogue = catalogue.loc[:, ["Drug", "Confers", "Interaction", "Literature",
-                                      "WHO Confidence", "Gene", "Mutation"]]
+        return catalogue.loc[:, ["Drug", "Confers", "Interaction", "Literature",
+                                 "WHO Confidence", "Gene", "Mutation"]]
+
+    def _parse(self, fasta_filepath, gff_filepath, download_dir, who_filepath=None):
+        """Parse WHO excel file, downloading it unless who_filepath is provided"""
+        if who_filepath is None:
+            who_filepath = self.download(download_dir)
+        # The excel parse is slow, so the normalised catalogue is cached per source file
+        catalogue = self.cache.cached(
+            "who", lambda: self.normalise_catalogue(self.read_catalogue(who_filepath)),
+            who_filepath)
+        #gff, catalogue, h37rv = self.read_files(gff_filepath, who_filepath, fasta_filepath)
+        #gff_dict = self.get_gene_info(gff)
         csv_outpath = os.path.join(download_dir, "who.csv")
         self.write_out_csv(catalogue, csv_outpath)
         return catalogue
@@ -0,0 +1,91 @@
+"""Module for low-memory, row-streaming reads of excel workbooks"""
+
+from itertools import islice
+import pandas as pd
+from openpyxl import load_workbook
+
+class Workbook:
+    """Class that streams xlsx sheets keeping only the wanted columns"""
+    @staticmethod
+    def fill_colour(cell):
+        """Hex value of a cell's fill colour, None if it is not filled"""
+        # Blank cells of read only sheets are EmptyCells without any style
+        fill = getattr(cell, "fill", None) if getattr(cell, "has_style", False) else None
+        if fill is None or fill.fill_type is None:
+            return None
+        colour = fill.start_color.index
+        return colour if isinstance(colour, str) else None
+
+    @staticmethod
+    def header_names(header_rows):
+        """Column names like pandas.read_excel: blanks in upper header rows are forward
+        filled (merged cells) and remaining blanks become 'Unnamed: i_level_j'"""
+        levels = []
+        for level, row in enumerate(header_rows):
+            names, previous = [], None
+            for idx, value in enumerate(row):
+                if value is None and level < len(header_rows) - 1 and previous is not None:
+                    value = previous
+                if value is None:
+                    value = f"Unnamed: {idx}" if len(header_rows) == 1 \
+                        else f"Unnamed: {idx}_level_{level}"
+                names.append(str(value) if not isinstance(value, str) else value)
+                previous = value
+            levels.append(names)
+        if len(levels) == 1:
+            return levels[0]
+        return list(zip(*levels))
+
+    @staticmethod
+    def fill_column_name(name):
+        """Name of the column holding the fill colours of column name"""
+        if isinstance(name, tuple):
+            return (*name[:-1], f"{name[-1]} fill")
+        return f"{name} fill"
+
+    @staticmethod
+    def read_sheet(xlsx_filepath, sheet_name, header=0, columns=None, fill_columns=()):
+        """Stream sheet into a DataFrame of the requested columns (all by default), adding
+        the fill colour of every fill_columns (names or positions) cell in the same pass"""
+        header = [header] if isinstance(header, int) else list(header)
+        workbook = load_workbook(xlsx_filepath, read_only=True, data_only=True)
+        try:
+            sheet = workbook[sheet_name]
+            rows = sheet.iter_rows(values_only=not fill_columns)
+            header_rows = []
+            for row in islice(rows, max(header) + 1):
+                header_rows.append([cell if not fill_columns else cell.value for cell in row])
+            header_rows = [header_rows[idx] for idx in header]
+            width = max(len(row) for row in header_rows)
+            header_rows = [row + [None] * (width - len(row)) for row in header_rows]
+            names = Workbook.header_names(header_rows)
+            wanted = names if columns is None else list(columns)
+            missing = [name for name in wanted if name not in names]
+            if missing:
+                raise ValueError(f"Columns {missing} not found in {xlsx_filepath} {sheet_name}")
+            col_idxs = [names.index(name) for name in wanted]
+            fill_idxs = [name if isinstance(name, int) else names.index(name)
+                         for name in fill_columns]
+            fill_columns = [names[idx] for idx in fill_idxs]
+            data = {name: [] for name in wanted}
+            fills = {name: [] for name in fill_columns}
+            for row in rows:
+                if fill_columns:
+                    cells = row
+                    row = [cell.value for cell in cells]
+                values = [row[idx] if idx < len(row) else None for idx in col_idxs]
+                if all(value is None for value in values):
+                    continue
+                for name, value in zip(wanted, values):
+                    data[name].append(value)
+                for name, idx in zip(fill_columns, fill_idxs):
+                    fills[name].append(Workbook.fill_colour(cells[idx]) if idx < len(cells)
+                                       else None)
+        finally:
+            workbook.close()
+        for name in fill_columns:
+            data[Workbook.fill_column_name(name)] = fills[name]
+        catalogue = pd.DataFrame(data)
+        if len(header) > 1:
+            catalogue.columns = pd.MultiIndex.from_tuples(catalogue.columns)
+        return catalogue
@@ -0,0 +1,133 @@
+"""Tests for cached downloads and concurrent task graphs against a local HTTP server"""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+from jasentool import download
+from jasentool.download import DownloadCache
+from jasentool.genome import Genome
+from jasentool.reference import Reference
+from jasentool.scheduler import TaskGraph
+
+FASTA = b">NC_1 test genome\nACGTACGTAC\nGTAC\n>NC_2\nGGGG\n"
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves fixed bodies with an ETag, failing paths a set number of times first"""
+    bodies = {"/catalogue.csv": b"Drug,Gene,Mutation\nrifampicin,rpoB,p.Ser450Leu\n",
+              "/slow": b"slow"}
+    failures = {}
+    requests = []
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Answer 304 to a matching If-None-Match, 5xx while failures remain"""
+        path = self.path.split("?")[0]
+        self.requests.append((path, self.headers.get("If-None-Match")))
+        if self.failures.get(path):
+            self.failures[path] -= 1
+            self.send_error(503)
+            return
+        if path == "/slow":
+            time.sleep(0.5)
+        body = FASTA if path == "/efetch" else self.bodies.get(path)
+        if body is None:
+            self.send_error(404)
+            return
+        etag = f'"{len(body)}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+@pytest.fixture(name="server")
+def fixture_server(monkeypatch):
+    """Local HTTP server in a thread, base url as value, with retry backoff disabled"""
+    monkeypatch.setattr(download, "sleep", lambda seconds: None)
+    monkeypatch.setattr("jasentool.genome.sleep", lambda seconds: None)
+    Handler.failures, Handler.requests = {}, []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_download_revalidates_with_304(server, tmp_path):
+    """A second download sends the ETag and reuses the cached bytes on 304"""
+    cache = DownloadCache(tmp_path / "cache")
+    for name in ("first.csv", "second.csv"):
+        cache.download(f"{server}/catalogue.csv", str(tmp_path / name))
+        assert (tmp_path / name).read_bytes() == Handler.bodies["/catalogue.csv"]
+    etag = f'"{len(Handler.bodies["/catalogue.csv"])}"'
+    assert Handler.requests == [("/catalogue.csv", None), ("/catalogue.csv", etag)]
+
+def test_download_retries_server_errors(server, tmp_path):
+    """5xx responses are retried until the download succeeds"""
+    Handler.failures["/catalogue.csv"] = 2
+    DownloadCache(tmp_path / "cache").download(f"{server}/catalogue.csv",
+                                               str(tmp_path / "out.csv"), retries=3)
+    assert (tmp_path / "out.csv").read_bytes() == Handler.bodies["/catalogue.csv"]
+    assert len(Handler.requests) == 3
+
+def test_download_does_not_retry_client_errors(server, tmp_path):
+    """4xx responses raise at once and leave no output behind"""
+    with pytest.raises(requests.exceptions.HTTPError):
+        DownloadCache(tmp_path / "cache").download(f"{server}/missing.csv",
+                                                   str(tmp_path / "out.csv"), retries=3)
+    assert len(Handler.requests) == 1
+    assert not (tmp_path / "out.csv").exists()
+
+def test_task_graph_runs_downloads_concurrently(server, tmp_path):
+    """Independent downloads overlap and dependants get their results"""
+    cache = DownloadCache(tmp_path / "cache")
+    graph = TaskGraph(4)
+    for idx in range(4):
+        graph.add(f"file_{idx}", lambda idx=idx: cache.download(
+            f"{server}/slow?{idx}", str(tmp_path / f"file_{idx}")))
+    graph.add("sizes", lambda **files: sorted(path.rsplit("_", 1)[1] for path in files.values()),
+              deps=[f"file_{idx}" for idx in range(4)])
+    start = time.perf_counter()
+    results = graph.run()
+    assert time.perf_counter() - start < 1.5
+    assert results["sizes"] == ["0", "1", "2", "3"]
+
+def test_task_graph_raises_download_failures(server, tmp_path):
+    """A failed download propagates out of run and its dependants never start"""
+    started = []
+    graph = TaskGraph(2)
+    graph.add("catalogue", lambda: DownloadCache(tmp_path / "cache").download(
+        f"{server}/missing.csv", str(tmp_path / "out.csv")))
+    graph.add("parse", lambda catalogue: started.append(catalogue), deps=("catalogue",))
+    with pytest.raises(requests.exceptions.HTTPError):
+        graph.run()
+    assert not started
+
+def test_genome_fasta_is_streamed_indexed_and_cached(server, tmp_path, monkeypatch):
+    """Entrez fasta is retried on 5xx, indexed while written and fetched once per accession"""
+    monkeypatch.setattr(Genome, "efetch_url", f"{server}/efetch")
+    Handler.failures["/efetch"] = 1
+    genome = Genome("NC_1", "AL1", str(tmp_path), "ref", cache_dir=str(tmp_path / "cache"))
+    for _ in range(2):
+        fasta_filepath = genome.download_fasta()
+    assert len(Handler.requests) == 2
+    with open(fasta_filepath, 'rb') as fin:
+        assert fin.read() == FASTA
+    with open(f"{fasta_filepath}.fai", 'r', encoding="utf-8") as fin:
+        assert fin.read() == "NC_1\t14\t18\t10\t11\nNC_2\t4\t40\t4\t5\n"
+    assert Reference.build_index(fasta_filepath) == Reference(fasta_filepath).index
+
+def test_genome_download_failure_raises(server, tmp_path, monkeypatch):
+    """Download errors are raised instead of returning a missing fasta path"""
+    monkeypatch.setattr(Genome, "efetch_url", f"{server}/missing")
+    genome = Genome("NC_1", "AL1", str(tmp_path), "ref", cache_dir=str(tmp_path / "cache"))
+    with pytest.raises(requests.exceptions.HTTPError):
+        genome.download_fasta()
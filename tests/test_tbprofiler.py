@@ -0,0 +1,92 @@
+"""Tests for the translation of tbdb mutations to genomic variants"""
+
+import random
+import pandas as pd
+import pytest
+from jasentool.reference import Reference
+from jasentool.tbprofiler import Tbprofiler
+
+# H37Rv (NC_000962.3) genes as (start, end, strand) and indels with their vcf positions
+H37RV_GENES = {"rpoB": (759807, 763325, "+"), "katG": (2153889, 2156111, "-"),
+               "pncA": (2288681, 2289241, "-")}
+H37RV_INDELS = [("rpoB", "c.1303_1308del", 761108), ("rpoB", "c.1296_1297insTTC", 761102),
+                ("katG", "c.10del", 2156101), ("pncA", "c.-11del", 2289251),
+                ("pncA", "c.10_11insA", 2289231)]
+
+def write_fasta(filepath, name, seq, width=80):
+    """Write seq as a wrapped single record fasta"""
+    with open(filepath, 'w', encoding="utf-8") as fout:
+        fout.write(f">{name}\n")
+        fout.write("".join(f"{seq[idx:idx + width]}\n" for idx in range(0, len(seq), width)))
+
+def translate(reference, gene_info, mutations):
+    """Translations of (gene, mutation) pairs"""
+    genes, mutations = zip(*mutations)
+    translated = Tbprofiler("").translate_mutations(pd.Series(mutations), pd.Series(genes),
+                                                     reference, gene_info)
+    assert not translated.fail.any(), translated.fail_reason.tolist()
+    return [translation[0] for translation in translated.translation]
+
+@pytest.fixture(name="genome")
+def fixture_genome(tmp_path):
+    """Random 300 base genome with a forward gene at 51-110 and a reverse one at 151-210"""
+    seq = "".join(random.Random(1).choices("ACGT", k=300))
+    fasta_filepath = tmp_path / "genome.fasta"
+    write_fasta(fasta_filepath, "chr", seq, width=70)
+    gene_info = {"fwd": {"chrom": "chr", "start": 51, "end": 110, "strand": "+"},
+                 "rev": {"chrom": "chr", "start": 151, "end": 210, "strand": "-"}}
+    return Reference(str(fasta_filepath)), gene_info, seq
+
+def test_indels_use_1_based_feature_coordinates(genome):
+    """c.1 is the first base of the feature and deletions are anchored on the base before"""
+    reference, gene_info, seq = genome
+    base = lambda pos: seq[pos - 1]
+    assert translate(reference, gene_info, [
+        ("fwd", "c.10del"), ("fwd", "c.-3del"), ("fwd", "c.10_11insA"),
+        ("rev", "c.10_11insA"), ("rev", "c.10del"), ("rev", "c.-2_2del"),
+    ]) == [
+        f"59{base(59)}{base(60)}>{base(59)}",
+        f"47{base(47)}{base(48)}>{base(47)}",
+        f"60{base(60)}>{base(60)}A",
+        f"200{base(200)}>{base(200)}T",
+        f"200{base(200)}{base(201)}>{base(200)}",
+        f"208{seq[207:212]}>{base(208)}",
+    ]
+
+def test_coordinate_free_mutations_need_no_gene_info():
+    """Amino acid, whole gene and range rules translate without gene coordinates"""
+    tbprofiler = Tbprofiler("")
+    assert tbprofiler.parse_mutation("p.Ser450Leu", "rpoB", None, {}) == ['450S>450L']
+    assert tbprofiler.parse_mutation("frameshift", "rpoB", None, {}) == ['frameshift']
+    assert tbprofiler.parse_mutation("any_missense_codon_3_4", "rpoB", None, {}) == \
+        ['any_missense_codon_3', 'any_missense_codon_4']
+
+def test_h37rv_indel_positions(tmp_path):
+    """Known H37Rv indels land on their genomic positions"""
+    seq = "".join(random.Random(2).choices("ACGT", k=2300000))
+    fasta_filepath = tmp_path / "h37rv.fasta"
+    write_fasta(fasta_filepath, "NC_000962.3", seq)
+    gene_info = {gene: {"chrom": "NC_000962.3", "start": start, "end": end, "strand": strand}
+                 for gene, (start, end, strand) in H37RV_GENES.items()}
+    translations = translate(Reference(str(fasta_filepath)), gene_info,
+                             [(gene, mutation) for gene, mutation, _ in H37RV_INDELS])
+    for (_, _, pos), translation in zip(H37RV_INDELS, translations):
+        assert translation.startswith(str(pos)) and translation[len(str(pos))].isalpha()
+
+def test_write_gene_pos_matches_row_formatting(tmp_path):
+    """Column-wise formatted chunks equal one formatted line per position"""
+    gene_table = tmp_path / "genes.txt"
+    gene_table.write_text("Rv1 a 1 120 -100 20\nRv2 b 990 1200 5 -205\nRv3 c 95 105 0 10\n"
+                          "Rv4 d 999990 1000020 -3 27\n", encoding="utf-8")
+    expected = []
+    for rv, chr_start, chr_end, gene_start, gene_end in [("Rv1", 1, 120, -100, 20),
+                                                         ("Rv2", 990, 1200, 5, -205),
+                                                         ("Rv4", 999990, 1000020, -3, 27)]:
+        step = 1 if gene_start < gene_end else -1
+        expected.extend(f"Chromosome\t{chr_pos}\t{rv}\t{gene_start + step * (chr_pos - chr_start + 1)}\n"
+                        for chr_pos in range(chr_start, chr_end + 1))
+    for chunk_size in (7, 1000000):
+        outfile = tmp_path / f"gene_pos_{chunk_size}.txt"
+        Tbprofiler("").write_gene_pos(str(gene_table), ["Rv1", "Rv2", "Rv4"], str(outfile),
+                                      chunk_size=chunk_size)
+        assert outfile.read_text(encoding="utf-8") == "".join(expected)